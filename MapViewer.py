@@ -10,7 +10,6 @@ import kivy
 kivy.require('1.0.7')
 
 from kivy.factory import Factory
-from kivy.cache import Cache
 from kivy.logger import Logger
 from kivy.loader import Loader
 from kivy.clock import Clock
@@ -24,25 +23,37 @@ from kivy.uix.image import Image
 from kivy.uix.popup import Popup
 from kivy.uix.label import Label
 
-from kivy.graphics import Color, Rectangle, Ellipse, Line
+from kivy.graphics import Color, Rectangle, Canvas
 from kivy.graphics.transformation import Matrix
 from kivy.vector import Vector
 
 import time, pickle
+from math import floor
 from os.path import join, dirname
 
 from TileServer import TileServer
+from tileatlas import TileBatch, crop_tex_coords
+from featurebatch import FeatureBatch
 from projections import *
 
-from WFSOverlayServer import GMLNS
 
 from os import _exit
 INACTIVITY_TIMEOUT = 300 # in s - if close_on_idle is True, mapviewer will exit the application after prolonged inactivity
+FALLBACK_DEPTH = 8       # number of zoom levels to look up for a cached ancestor of a missing tile
+RETRY_POLL = 1           # in s - redraw interval while tiles are missing, to retry failed downloads
 
 ### static configuration - to be parametrized #################################################
 # size of tiles
 TILE_W = 256
 TILE_H = 256
+# prefetch tiles along the pan/zoom trajectory, this many seconds ahead
+PREFETCH_LOOKAHEAD = .5
+# weight of the last move in the smoothed velocity
+PREFETCH_SMOOTHING = .5
+# seconds without move after which the map is considered still
+PREFETCH_IDLE = .3
+# zoom rate (levels/s) above which the next zoom level is prefetched
+PREFETCH_ZOOMRATE = .5
 ###############################################################################################
 
 
@@ -54,6 +65,18 @@ class MapViewerPlane(ScatterPlane):
             Provider to use
         `tileserver`: TileServer, default to None
             Specify a custom tileserver class to use
+        `status_cb`: callable, default to None
+            Called after each draw with the number of pending tiles, the
+            number of tiles in view and the tile queue statistics (dict)
+
+    The canvas is retained: draw() only runs when the view was marked dirty
+    (transform change, tile arrival, overlay or provider change, see
+    mark_dirty) or while something is fading in, and only touches the tile
+    meshes that changed.
+
+    There is no fixed rate timer: update() is scheduled for the next frame
+    by these events, keeps rescheduling itself while something is moving or
+    fading, and stops when the view is static.
   '''
   
   def __init__(self, **kwargs):
@@ -66,19 +89,45 @@ class MapViewerPlane(ScatterPlane):
     self.status_cb    = kwargs.get('status_cb', None) # return debug information to callback method
     self.legend_cb    = kwargs.get('legend_cb', None) # return debug information to callback method
 
+    # retained canvas: background, tile meshes, overlays
+    self._dirty = True        # something changed, draw on next update
+    self._animating = False   # something fades in, draw on every update
+    self._incomplete = False  # tiles are missing, poll for them
+    self._cache_bbox = None 
+    self._trigger_update = Clock.create_trigger(self.update)          # next frame
+    self._trigger_poll = Clock.create_trigger(self.update, RETRY_POLL)
+    self.batch = TileBatch()
+    self.drawcalls = 0
+    with self.canvas:
+      Color(0, 0, 0)
+      Rectangle(pos=(0,0), size=(2000,2000))
+    self.tile_canvas = Canvas()
+    self.tile_canvas.add(self.batch.group)
+    self.overlay_canvas = Canvas()
+    self.canvas.add(self.tile_canvas)
+    self.canvas.add(self.overlay_canvas)
+
     self._tileserver = None
     self.tileserver = kwargs.get('tileserver', None)
     self.maptype = kwargs.get('maptype', 'roadmap')
     if self.tileserver is None:
         self.provider = kwargs.get('provider', 'bing')
     self.tiles = []
+    self._visible = []           # keys of the tiles in view
+    self._fallbacks = []         # keys of the cached tiles standing in for missing ones
+    self._pinned_fallbacks = None
     
-    self._cache_bbox = None 
     self._dt = 1
     
-    self.lastmove = 0
+    self.lastmove = None  # time of the last move, None before the first
+    self.velocity = Vector(0, 0) # of the viewport centre, in plane units/s
+    self.zoomrate = 0            # in zoom levels/s
+    self._lastsample = None
     self.overlays = []
     self.overlaycache = {}
+    self.overlay_batches = {}    # tiled overlay -> TileBatch
+    self.overlay_viewports = {}  # tiled overlay -> (tile bbox, visible tiles) sent to its tileserver
+    self.overlay_features = {}   # wfs overlay -> FeatureBatch
     
     self.quality = 1
     self.maxzoomlevel = 35
@@ -91,12 +140,43 @@ class MapViewerPlane(ScatterPlane):
     
     self.loadtimes = {}
     
-    Clock.schedule_interval(self.update, .1)
+    self.bind(transform=self.mark_dirty, parent=self._bind_parent)
+
+  def mark_dirty(self, *largs):
+    '''Ask for a redraw on the next frame, e.g. after changing overlays'''
+    self._dirty = True
+    self._trigger_update()
+
+  def _bind_parent(self, instance, parent):
+    if parent is not None:
+      parent.bind(pos=self.mark_dirty, size=self.mark_dirty)
+    self.mark_dirty()
+
+  def _exit_idle(self, dt):
+    _exit(1)
+
+  def overlay_tileservers(self):
+    return [overlay.tileserver for overlay in self.overlays
+            if getattr(overlay, 'tiled', False)]
 
   def update(self, dt):
     self._dt = dt
-    self.tileserver.update()
-    self.draw()
+    servers = [self.tileserver] + self.overlay_tileservers()
+    for server in servers:
+      if server.update():
+        self._dirty = True
+    if self.parent is None:
+      return
+    if self._dirty or self._animating or self._incomplete:
+      self.draw()
+
+    # keep going at the display rate while something changes, else sleep
+    # until the next event (touch, tile arrival), polling slowly for the
+    # tiles that failed
+    if self._animating or any(server.q_out for server in servers):
+      self._trigger_update()
+    elif self._incomplete:
+      self._trigger_poll()
     
   def _get_provider(self):
         if self._tileserver:
@@ -117,11 +197,23 @@ class MapViewerPlane(ScatterPlane):
         if x == self._tileserver:
             return
         if self._tileserver is not None:
+            self._tileserver.on_arrival = None
             self._tileserver.stop()
         self._tileserver = x
+        self._tileserver.on_arrival = self._trigger_update
         self._tileserver.start()
+        self._cache_bbox = None  # hand the viewport to the new tileserver
+        self.mark_dirty()
   tileserver = property(_get_tileserver, _set_tileserver)
 
+  def _get_maptype(self):
+        return self._maptype
+  def _set_maptype(self, x):
+        self._maptype = x
+        self._cache_bbox = None
+        self.mark_dirty()
+  maptype = property(_get_maptype, _set_maptype)
+
   
   @property
   def zoom(self):
@@ -232,7 +324,7 @@ class MapViewerPlane(ScatterPlane):
     return self.tileserver.exist(nx, bound-ny-1, zoom, self.maptype)
 
   def tile_draw(self, nx, ny, tx, ty, sx, sy, zoom, bound):
-        '''Draw a specific tile on the screen.
+        '''Add a specific tile to the batch committed at the end of the frame.
         Return False if the tile is not yet available.'''
         # nx, ny = index of tile
         # tx, ty = real position on scatter
@@ -240,26 +332,69 @@ class MapViewerPlane(ScatterPlane):
         # pzoom = current zoom level
         image = self.tileserver.get(nx, bound-ny-1, zoom, self.maptype)
         if image in (None, False):
-            return
+            self.tile_fallback(nx, ny, tx, ty, sx, sy, zoom, bound)
+            return False
 
         if not image.texture:
           Logger.exception('Returned image has no texture.')
-          return
+          self.tile_fallback(nx, ny, tx, ty, sx, sy, zoom, bound)
+          return False
         if image.texture.wrap is None:
           image.texture.wrap = GL_CLAMP
 
-        alpha = Cache.get('tileserver.tilesalpha', image.id)
-        if alpha is None:
-          alpha = 0
-        if image.loaded:          # as soon as we have the image
-          alpha += min(self._dt * 4, 1.0)  # fade it in
-        Cache.append('tileserver.tilesalpha', image.id, alpha)
-
-        with self.canvas:
-          Color(1, 1, 1, alpha)
-          Rectangle(pos=(tx, ty), size=(sx, sy), texture=image.texture)
+        alpha = getattr(image, 'alpha', 0)
+        if image.loaded and alpha < 1:   # as soon as we have the image
+          alpha = min(alpha + min(self._dt * 4, 1.0), 1.0)  # fade it in
+          image.alpha = alpha
+        if alpha < 1:
+          self._animating = True
+          self.tile_fallback(nx, ny, tx, ty, sx, sy, zoom, bound) # seen through
+
+        self.batch.add((image.id, tx, ty), image.texture, tx, ty, sx, sy, alpha)
+        return True
+
+  def tile_fallback(self, nx, ny, tx, ty, sx, sy, zoom, bound):
+        '''Stand in for a missing tile with cached tiles of other zoom
+        levels: its four children if they are all cached, else the part of
+        its nearest cached ancestor covering it. Never asks for downloads.
+        Return False if nothing was found.'''
+        peek = self.tileserver.peek
+        maptype = self.maptype
+        row = bound - ny - 1  # tile server orientation
+
+        if zoom < self.maxzoomlevel:
+          children = [((2 * nx + i, 2 * row + j, zoom + 1, maptype, 'png'), i, j)
+                      for j in (0, 1) for i in (0, 1)]
+          images = [peek(*key) for key, i, j in children]
+          if all(self.tile_ready(image) for image in images):
+            hx, hy = sx / 2., sy / 2.
+            for (key, i, j), image in zip(children, images):
+              x, y = tx + i * hx, ty + (1 - j) * hy  # j = 0 is the north half
+              self.batch.add((image.id, x, y), image.texture, x, y, hx, hy, 1)
+              self._fallbacks.append(key)
+            return True
+
+        for dz in xrange(1, min(FALLBACK_DEPTH, zoom - 1) + 1):
+          key = (nx >> dz, row >> dz, zoom - dz, maptype, 'png')
+          image = peek(*key)
+          if not self.tile_ready(image):
+            continue
+          n = float(1 << dz)
+          fx, fy = nx - (key[0] << dz), row - (key[1] << dz)
+          coords = crop_tex_coords(image.texture.tex_coords,
+                                   fx / n, 1 - (fy + 1) / n, 1 / n)
+          self.batch.add((image.id, tx, ty), image.texture, tx, ty, sx, sy, 1, coords)
+          self._fallbacks.append(key)
+          return True
+        return False
+
+  def tile_ready(self, image):
+        return image not in (None, False) and image.loaded and image.texture
     
   def draw(self): 
+    self._dirty = False
+    self._animating = self._lastsample is not None  # keep prefetching while moving
+
     # calculate boundaries
     parent = self.parent
     
@@ -282,105 +417,158 @@ class MapViewerPlane(ScatterPlane):
     self.cmax  = self.to_local(xmax, ymax)
     self.csize = self.cmax[0]-self.cmin[0], self.cmax[1]-self.cmin[1]
     
-    # draw background
-    self.canvas.clear()
-    with self.canvas:
-      Color(0, 0, 0)
-      Rectangle(pos=(0,0), size=(2000,2000))
-
     # check if we must invalidate the tiles
     bbox = self.tile_bbox(self.zoom)
     if self._cache_bbox != bbox:
       self._cache_bbox = bbox
       self.tiles = []
+      self.tileserver.set_viewport(self.zoom, self.viewport_fractions())
 
     if not self.tiles:
-      # precalculate every tiles needed for each zoom
-      # from the current zoom to the minimum zoom
-      # if the current zoom is completly loaded,
-      # drop the previous zoom
+      # precalculate the tiles of the current zoom only, missing ones are
+      # replaced tile by tile in tile_fallback
       self.tiles = tiles = []
-      will_break = False
-      for z in xrange(self.zoom, 0, -1): #self.zoom-1
-        if self.compute_tiles_for_zoom(z, tiles):
-          if z > 0:
-            self.compute_tiles_for_zoom(z - 1, tiles)
-          break
-
-    # now draw tiles, center first
+      self.compute_tiles_for_zoom(self.zoom, tiles)
+      self._visible = [(nx, bound-ny-1, zoom, self.maptype, 'png')
+                       for nx, ny, tx, ty, sx, sy, zoom, bound in tiles]
+      self._pinned_fallbacks = None
+
+    # now update the retained tile meshes, center first, batched by atlas page
+    self._incomplete = False
+    self._fallbacks = []
+    self.batch.begin()
     for tile in reversed(self.tiles):
-      self.tile_draw(*tile)
-    
-    if (not self.lastmove is 0) and time.time() > self.lastmove + INACTIVITY_TIMEOUT: 
-        _exit(1)
+      if not self.tile_draw(*tile):
+        self._incomplete = True
+    self.batch.commit()
+
+    # keep the tiles in view, and the ones standing in for them, in memory
+    if self._fallbacks != self._pinned_fallbacks:
+      self._pinned_fallbacks = self._fallbacks
+      self.tileserver.pin(self._visible + self._fallbacks)
+    self.drawcalls = self.batch.drawcalls
+    self.prefetch()
 
     if self.legend_cb:
         self.legend_cb(None)
         
+    # overlays are rebuilt on every draw, which only happens when needed
+    self.overlay_canvas.clear()
+    for overlay in self.overlay_batches.keys():
+      if overlay not in self.overlays:
+        del self.overlay_batches[overlay]
+        self.overlay_viewports.pop(overlay, None)
+        overlay.stop()  # removed or replaced: release its workers
+    for overlay in self.overlay_features.keys():
+      if overlay not in self.overlays:
+        del self.overlay_features[overlay]
     for overlay in self.overlays:
-      if overlay.type == "wms":
+      if overlay.type == "wms" and overlay.tiled:
+          self.overlay_tiles_draw(overlay)
+
+      elif overlay.type == "wms":
+          name = overlay.provider_name+overlay.layer
+          loadtimes = self.loadtimes.setdefault(name, {})
           image = None
           if self.lastmove is None or time.time() > self.lastmove + 0.5: # wait a second after moving before we try to contact the WMS
             image = overlay.get(self, parent.width, parent.height)
+          else:
+            self._animating = True
           oldalpha = overlay.max_alpha
           if (image not in (None, False)) and image.loaded:
-            if image not in self.loadtimes:
-              self.loadtimes[image]=time.time()
-            alpha = max(0,min((time.time()-self.loadtimes[image]) * 1, overlay.max_alpha))  # fadein
+            if image not in loadtimes:
+              loadtimes[image]=time.time()
+            alpha = max(0,min((time.time()-loadtimes[image]) * 1, overlay.max_alpha))  # fadein
             oldalpha = overlay.max_alpha - alpha
+            pos, isize = getattr(image, 'area', (self.cmin, self.csize))
             if oldalpha == 0: # as soon as the old image is faded out, put this one in the cache
-              self.overlaycache[overlay.provider_name+overlay.layer] = image, self.cmin, self.csize # self.omin, osize
-            with self.canvas:
+              self.overlaycache[name] = image, pos, isize
+              self.loadtimes[name] = {image: loadtimes[image]}
+            else:
+              self._animating = True
+            with self.overlay_canvas:
               Color(1, 1, 1, alpha)
-              Rectangle(pos=self.cmin, size=self.csize, texture=image.texture)
+              Rectangle(pos=pos, size=isize, texture=image.texture)
+            self.drawcalls += 1
+          elif image not in (None, False):
+            self._animating = True  # wait for the image to load
 
           # try displaying the previous image from this overlay, until the next one is fully displayed
-          image, pos, isize = self.overlaycache.get(overlay.provider_name+overlay.layer, (None, None, None))
-          if image:
-            with self.canvas:
+          previous = image
+          image, pos, isize = self.overlaycache.get(name, (None, None, None))
+          if image and image is not previous:
+            with self.overlay_canvas:
               Color(1, 1, 1, oldalpha)
               Rectangle(pos=pos, size=isize, texture=image.texture)
-              
-          if self.legend_cb:
-            # display the legend graphic
-            image = overlay.getLegendGraphic()
-            if image.loaded:
-              self.legend_cb(image)
+            self.drawcalls += 1
 
       elif overlay.type == "wfs":
-          geometries = None
-          if self.lastmove is None or time.time() > self.lastmove + 0.5: # wait a second after moving before we try to contact the WFS
-            geometries = overlay.get(self, parent.width, parent.height)
+          overlay.on_arrival = self._trigger_update
+          geometries = overlay.get(self, parent.width, parent.height)
+          if overlay.pending():
+            self._incomplete = True
           if geometries is not None:
-            with self.canvas:
-              for geom in geometries:
-                if geom.tag == "{%s}Point" % GMLNS:
-                  copos = map(float,geom.getchildren()[0].text.split())
-                  l, m = overlay.co_to_ll(copos[0], copos[1])
-                  x,y = self.get_xy_from_latlon(l, m) 
-                  
-                  Color(0, 0, 0)
-                  r = 10.0/self.scale
-                  Ellipse(pos=(x-r/2, y-r/2), size=(r,r))
-                  Color(1, 1, 1)
-                  r = 8.0/self.scale
-                  Ellipse(pos=(x-r/2, y-r/2), size=(r,r))
-                  print x,y,r
-                elif geom.tag == "{%s}LinearRing" % GMLNS:
-                  #copos = map(float,geom.getchildren()[0].text.split())
-                  #points = []
-                  #for i in xrange(0,len(copos),2):
-                  #  l, m = overlay.co_to_ll(copos[0], copos[1])
-                  #  x, y = self.get_xy_from_latlon(l, m) 
-                  #  points.append(x)
-                  #  points.append(y)
-                  #points.extend(points[0:1])
-                  #Color(1, 0.5, 0.5)
-                  #Line(points=points)
-                  pass
+            # the batch is only rebuilt when the list of features or the
+            # zoom level (hence the level of detail) changes
+            batch = self.overlay_features.get(overlay)
+            if batch is None:
+              batch = self.overlay_features[overlay] = FeatureBatch(TILE_W, TILE_H)
+            if batch.features is not geometries or batch.zoom != self.zoom:
+              batch.build(geometries, self.zoom)
+            batch.set_scale(self.scale)
+            self.overlay_canvas.add(batch.group)
+            self.drawcalls += batch.drawcalls
+
+      if overlay.type == "wms" and self.legend_cb:
+          # display the legend graphic
+          image = overlay.getLegendGraphic()
+          if image.loaded:
+            self.legend_cb(image)
           
     if self.status_cb:
-      self.status_cb(self.tileserver.q_count, self.tilecount)
+      stats = self.tileserver.stats()
+      stats['drawcalls'] = self.drawcalls
+      self.status_cb(self.tileserver.q_count, self.tilecount, stats)
+
+  def viewport_fractions(self):
+    '''Return the visible area as world fractions (x1, y1, x2, y2) in tile
+       server orientation (y growing southwards)'''
+    minx, miny = self.omin
+    maxx, maxy = self.omax
+    return (minx / (2.0 * TILE_W), 1 - maxy / (2.0 * TILE_H),
+            maxx / (2.0 * TILE_W), 1 - miny / (2.0 * TILE_H))
+
+  def overlay_tiles_draw(self, overlay):
+    '''Draw a tiled overlay on the grid of the base map tiles'''
+    server = overlay.tileserver
+    server.on_arrival = self._trigger_update
+    viewport = self.overlay_viewports.get(overlay)
+    if viewport is None or viewport[0] != self._cache_bbox:
+      server.set_viewport(self.zoom, self.viewport_fractions())
+    if viewport is None or viewport[1] is not self._visible:
+      server.pin([(nx, ny, zoom, overlay.layer, format)
+                  for nx, ny, zoom, maptype, format in self._visible])
+    self.overlay_viewports[overlay] = (self._cache_bbox, self._visible)
+
+    batch = self.overlay_batches.get(overlay)
+    if batch is None:
+      batch = self.overlay_batches[overlay] = TileBatch()
+    batch.begin()
+    for nx, ny, tx, ty, sx, sy, zoom, bound in reversed(self.tiles):
+      image = server.get(nx, bound-ny-1, zoom, overlay.layer)
+      if image in (None, False) or not image.texture:
+        self._incomplete = True
+        continue
+      alpha = getattr(image, 'alpha', 0)
+      if image.loaded and alpha < 1:
+        alpha = min(alpha + min(self._dt * 4, 1.0), 1.0)  # fade it in
+        image.alpha = alpha
+      if alpha < 1:
+        self._animating = True
+      batch.add((image.id, tx, ty), image.texture, tx, ty, sx, sy, alpha * overlay.max_alpha)
+    batch.commit()
+    self.overlay_canvas.add(batch.group)
+    self.drawcalls += batch.drawcalls
 
   def checkTooltips(self, touch):
     l, m = self.get_latlon_from_xy(*touch.pos)
@@ -393,9 +581,71 @@ class MapViewerPlane(ScatterPlane):
         popup.open()
         break
       
+  def tile_keys(self, zoom, pmin, pmax):
+    '''Return the tile server keys of the tiles covering the plane area
+       pmin-pmax at `zoom`, nearest to the viewport centre first'''
+    pzoom = pow(2, zoom - 1)
+    bound = int(pow(2, zoom))
+    tw = TILE_W / float(pzoom)
+    th = TILE_H / float(pzoom)
+    cx = (self.omin[0] + self.omax[0]) / 2.
+    cy = (self.omin[1] + self.omax[1]) / 2.
+    cells = [(x, y) for x in xrange(int(floor(pmin[0] / tw)), int(floor(pmax[0] / tw)) + 1)
+                    for y in xrange(int(floor(pmin[1] / th)), int(floor(pmax[1] / th)) + 1)]
+    cells.sort(key=lambda (x, y): ((x + .5) * tw - cx) ** 2 + ((y + .5) * th - cy) ** 2)
+    return [(x % bound, bound - (y % bound) - 1, zoom, self.maptype, 'png')
+            for x, y in cells]
+
+  def track_velocity(self):
+    '''Update the smoothed pan velocity and zoom rate after a move'''
+    now = time.time()
+    center = Vector(self.to_local(*self.parent.center))
+    zoom = log(self.scale, 2)
+    if self._lastsample is not None:
+      t, c, z = self._lastsample
+      dt = now - t
+      if dt > PREFETCH_IDLE:      # new gesture
+        self.velocity = Vector(0, 0)
+        self.zoomrate = 0
+      elif dt > 0:
+        a = PREFETCH_SMOOTHING
+        self.velocity = self.velocity * (1 - a) + (center - c) * (a / dt)
+        self.zoomrate = self.zoomrate * (1 - a) + (zoom - z) * (a / dt)
+    self._lastsample = (now, center, zoom)
+
+  def prefetch(self):
+    '''Ask the tileserver for the tiles along the predicted trajectory: the
+       viewport moved by the current velocity, and the next zoom level when
+       zooming fast'''
+    if self.lastmove is None or time.time() > self.lastmove + PREFETCH_IDLE:
+      if self._lastsample is not None:   # stopped moving, cancel prefetch
+        self._lastsample = None
+        self.velocity = Vector(0, 0)
+        self.zoomrate = 0
+        self.tileserver.prefetch([])
+      return
+
+    zoom = self.zoom
+    shift = self.velocity * PREFETCH_LOOKAHEAD
+    omin, omax = Vector(self.omin), Vector(self.omax)
+    tiles = []
+    if shift.length() > 0:
+      tiles.extend(self.tile_keys(zoom, omin + shift, omax + shift))
+    if abs(self.zoomrate) > PREFETCH_ZOOMRATE:
+      nextzoom = self.zoomrate > 0 and zoom + 1 or zoom - 1
+      factor = pow(2, -self.zoomrate * PREFETCH_LOOKAHEAD)  # viewport size ratio
+      center = (omin + omax) * .5 + shift
+      half = (omax - omin) * (.5 * factor)
+      if nextzoom >= 1:
+        tiles.extend(self.tile_keys(nextzoom, center - half, center + half))
+    self.tileserver.prefetch(tiles)
+
   def on_touch_move(self, touch):
     super(MapViewerPlane, self).on_touch_move(touch) # delegate to scatterplane first
     self.lastmove = time.time()
+    self.track_velocity()
+    Clock.unschedule(self._exit_idle)
+    Clock.schedule_once(self._exit_idle, INACTIVITY_TIMEOUT)
     
   def on_touch_down(self, touch):
     super(MapViewerPlane, self).on_touch_down(touch) # delegate to scatterplane first
@@ -406,7 +656,10 @@ class MapViewerPlane(ScatterPlane):
     '''Get latitude/longitude from x/y in scatter (x/y will be transformed
        in scatter coordinate space)
     '''                                  # FIXME: grok + document
-    x, y = self.to_local(x, y)           # transform into scatterplane space
+    return self.get_latlon_from_local(*self.to_local(x, y))
+
+  def get_latlon_from_local(self, x, y):
+    '''Get latitude/longitude from x/y in scatterplane space'''
     p = Vector(x, y) / (TILE_W, TILE_H)  # 
     nx = (p.x % 2) - 1                   # bind into range [-1, 1[
     ny = 1 - (p.y % 2)                   # bind into range ]-1, 1]
@@ -2,32 +2,59 @@ import kivy
 kivy.require('1.0.7')
 
 from kivy.loader import Loader
-from kivy.cache import Cache
 from kivy.logger import Logger
 from kivy.factory import Factory
 
 from kivy.core.image import Image
+from kivy.graphics.texture import Texture
 
 from os.path import join, dirname, exists, isdir, isfile, sep
 from os import makedirs, mkdir, _exit
 from collections import deque
-from threading import Condition, Thread, Event
-#from httplib import HTTPConnection
-from urllib2 import urlopen
+from StringIO import StringIO
+from threading import Thread
+from time import time
 from random import randint
 
 from projections import *
+from tileaddress import quadkey, to_yahoo, tile_center
+from connectionpool import HTTPConnectionPool
+from tilescheduler import TileScheduler
+from TileStore import TileStore
+from cachejanitor import CacheJanitor
+from tilecache import TileMemoryCache
+from tiledecoder import DecodedTile, decode_tile, can_decode
+from tileatlas import TileAtlas, AtlasTile
 
 ### static configuration - TODO: parametrize ####################################
 # number of threads to use
 TILESERVER_POOLSIZE = 10
 TILESERVER_MAXPIPELINE = 2
+# seconds before a failed tile is requested again
+TILESERVER_RETRY = 10
+# disk cache backend - see TileStore.backends ('directory' or 'mbtiles')
+TILESERVER_STORE = 'directory'
+# disk cache budget per provider in bytes (0 for unbounded)
+TILESERVER_CACHE_BUDGET = 256 * 1024 * 1024
+# default memory budget for decoded tiles in bytes (~256 tiles of 256x256)
+TILESERVER_MEMORY_BUDGET = 64 * 1024 * 1024
+# maximum number of queued prefetch requests
+TILESERVER_PREFETCH_MAX = 24
+# per frame budget for texture uploads, in ms and in bytes
+TILESERVER_UPLOAD_MS = 4
+TILESERVER_UPLOAD_BYTES = 2 * 1024 * 1024
 #################################################################################
 
-### init cache - TODO: parametrize ##############################################
-Cache.register('tileserver.tiles', limit=10, timeout=10) #1000/10000
-Cache.register('tileserver.tilesalpha', limit=10, timeout=10)
-#################################################################################
+class Tile(object):
+    '''A tile uploaded to its own texture (see AtlasTile for tiles in the
+    atlas), as stored in the memory cache'''
+    __slots__ = ('id', 'texture', 'loaded', 'alpha')
+
+    def __init__(self, id, texture):
+        self.id      = id
+        self.texture = texture
+        self.loaded  = True
+        self.alpha   = 0
 
 class TileServer(object):
     '''Base implementation for a tile provider.
@@ -35,27 +62,44 @@ class TileServer(object):
     '''
     provider_name = 'unknown'
     providers = dict()
+    cache_budget = TILESERVER_CACHE_BUDGET
     
     @staticmethod
     def register(cls):
         TileServer.providers[cls.provider_name] = cls
 
-    def __init__(self, poolsize=TILESERVER_POOLSIZE):
+    def __init__(self, poolsize=TILESERVER_POOLSIZE, store=TILESERVER_STORE,
+                 cache_budget=None, memory_budget=TILESERVER_MEMORY_BUDGET,
+                 upload_ms=TILESERVER_UPLOAD_MS, upload_bytes=TILESERVER_UPLOAD_BYTES):
         self.cache_path = join(dirname(__file__), 'cache', self.provider_name)
-        if not isdir(self.cache_path):
-            makedirs(self.cache_path)
+        if isinstance(store, TileStore):
+            self.store = store
+        else:
+            self.store = TileStore.create(store, self.cache_path)
+        if cache_budget is not None:
+            self.cache_budget = cache_budget
+        self.janitor = None
+        if self.cache_budget:
+            self.janitor = CacheJanitor(self.store, self.cache_budget)
 
         black = Loader.image(join('documents','black.png'))
         #Loader._loading_image = black
             
-        self.q_in       = deque()
+        self.scheduler  = TileScheduler(prefetch_slots=max(1, poolsize / 2))
+        self.atlas      = TileAtlas()
+        self.memory     = TileMemoryCache(memory_budget, on_evict=self.release)
+        self.upload_ms  = upload_ms
+        self.upload_bytes = upload_bytes
+        self.upload_stats = dict(frames=0, uploads=0, carried=0, upload_bytes=0,
+                                 frame_ms=0., max_frame_ms=0., avg_frame_ms=0.)
         self.q_out      = deque()
-        self.q_count    = 0
-        self.c_in       = Condition()
+        self.failed     = dict()
         self.workers    = []
         self.poolsize   = poolsize
         self.uniqid     = 1
+        self.pool       = HTTPConnectionPool(maxsize=poolsize)
         self.want_close = False
+        self.on_arrival = None  # called from the workers when q_out grows
         self.available_maptype = dict(roadmap='Roadmap')
         self.hcsvnt     = Loader.image(join('documents','hcsvnt.png'))
         
@@ -65,12 +109,14 @@ class TileServer(object):
         '''
         for i in xrange(self.poolsize):
             self.create_worker()
+        if self.janitor:
+            self.janitor.start()
 
     def create_worker(self):
         '''Create a new worker, and append to the list of current workers
         '''
         thread = Thread(target=self._worker_run,
-                        args=(self.c_in, self.q_in, self.q_out))
+                        args=(self.scheduler, self.q_out))
         thread.daemon = True
         thread.start()
         self.workers.append(thread)
@@ -79,9 +125,16 @@ class TileServer(object):
         '''Stop all workers
         '''
         self.want_close = True
+        self.scheduler.wakeup()
+        if self.janitor:
+            self.janitor.stop()
         if wait:
             for x in self.workers:
                 x.join()
+        Logger.info('TileServer: %s: %d requests, %d%% over reused connections' % (
+            self.provider_name, self.pool.stats['requests'], 100 * self.pool.reuse_ratio))
+        self.pool.close()
+        self.store.flush()
 
 
     def post_download(self, filename):
@@ -89,164 +142,283 @@ class TileServer(object):
         doing some image processing, like cropping
 
         .. warning::
-            This function is called inside a worker Thread.
+            This function is called inside a worker Thread, and only for
+            stores keeping one file per tile (see TileStore.filename).
         '''
         pass
 
+    @property
+    def q_count(self):
+        '''Number of tiles queued or being downloaded'''
+        return len(self.scheduler)
+
+    def stats(self):
+        '''Return queue depth and memory cache statistics'''
+        stats = self.scheduler.depth()
+        stats.update(self.memory.info())
+        stats.update(self.upload_stats)
+        return stats
+
+    def pin(self, tiles):
+        '''Protect the given tiles (nx, ny, zoom, maptype, format) from being
+        evicted from the memory cache, typically the ones in view'''
+        self.memory.pin([self.to_id(*tile) for tile in tiles])
+
+    def prefetch(self, tiles, limit=TILESERVER_PREFETCH_MAX):
+        '''Queue low priority requests for tiles (nx, ny, zoom, maptype,
+        format) likely to be needed soon. Replaces the previous prefetch
+        requests still queued.'''
+        now = time()
+        keys = [tile for tile in tiles
+                if self.to_id(*tile) not in self.memory and
+                   now >= self.failed.get(tile, 0) + TILESERVER_RETRY]
+        self.scheduler.prefetch(keys, limit)
+
+    def set_viewport(self, zoom, bbox):
+        '''Set the visible area, as (x1, y1, x2, y2) world fractions with y
+        growing southwards. Queued tiles out of view are dropped.
+        '''
+        self.scheduler.set_viewport(zoom, bbox)
+
     def to_filename(self, nx, ny, zoom, maptype, format):
-        fid = self.to_id(nx, ny, zoom, maptype, format)
-        hash = fid[0:2]
-        return join(self.cache_path, hash, fid)
+        '''Return the cache file of a tile, or None if the store does not
+        keep tiles as files'''
+        return self.store.filename((nx, ny, zoom, maptype, format))
 
     def to_id(self, nx, ny, zoom, maptype, format):
         return '%d_%d_%d_%s.%s' % (nx, ny, zoom, maptype, format)
 
     def exist(self, nx, ny, zoom, maptype, format='png'):
-        filename = self.to_filename(nx, ny, zoom, maptype, format)
-        img = Cache.get('tileserver.tiles', filename)
-        return bool(img)
+        fid = self.to_id(nx, ny, zoom, maptype, format)
+        return fid in self.memory
+
+    def peek(self, nx, ny, zoom, maptype, format='png'):
+        '''Get a tile if it is in the memory cache, never download it
+        '''
+        return self.memory.peek(self.to_id(nx, ny, zoom, maptype, format))
 
     def get(self, nx, ny, zoom, maptype, format='png'):
         '''Get a tile
         '''
-        filename = self.to_filename(nx, ny, zoom, maptype, format)
-        img = Cache.get('tileserver.tiles', filename)
-
-        # check if the tile is already being loaded
-        if img is False:
-            return None
+        fid = self.to_id(nx, ny, zoom, maptype, format)
+        img = self.memory.get(fid)
+        key = (nx, ny, zoom, maptype, format)
 
         # check if the tile exist in the cache
         if img is not None:
+            if self.janitor:
+                self.janitor.touch(key)  # still in use: keep it on disk
             return img
 
-        # no tile, ask to workers to download 
-        Cache.append('tileserver.tiles', filename, False)
-        self.q_count += 1
-        self.q_in.append((nx, ny, zoom, maptype, format))
-        self.c_in.acquire()
-        self.c_in.notify()
-        self.c_in.release()
+        # check if the tile failed recently
+        if key in self.failed:
+            if time() < self.failed[key] + TILESERVER_RETRY:
+                return None
+            del self.failed[key]
+
+        # no tile, ask to workers to download (noop if already queued)
+        self.scheduler.push(key)
         return None
 
     def update(self):
-        '''Must be called to get pull image from the workers queue
+        '''Must be called to get pull image from the workers queue.
+        Decoded tiles are uploaded to textures until the per frame budget
+        (upload_ms, upload_bytes) is spent, the others are left for the next
+        frame. Return the number of tiles added to the memory cache.
         '''
-        
-        pop = self.q_out.pop
-        while True:
+        q_out = self.q_out
+        stats = self.upload_stats
+        start = time()
+        deadline = start + self.upload_ms / 1000.
+        uploaded = count = 0
+        while q_out:
+            if count and (time() > deadline or uploaded >= self.upload_bytes):
+                break
             try:
-                filename, image = pop()
-                self.q_count -= 1
-            except:
-                return
-            Cache.append('tileserver.tiles', filename, image)
-
-    def _worker_run(self, c_in, q_in, q_out):
+                key, fid, image = q_out.pop()
+            except IndexError:
+                break
+            if image is None:
+                self.failed[key] = time()
+            else:
+                if isinstance(image, DecodedTile):
+                    uploaded += len(image.pixels)
+                    image = self.upload(image)
+                self.memory.put(fid, image)
+                count += 1
+            self.scheduler.done(key)
+
+        elapsed = (time() - start) * 1000.
+        stats['frames'] += 1
+        stats['uploads'] += count
+        stats['upload_bytes'] += uploaded
+        stats['carried'] = len(q_out)
+        stats['frame_ms'] = elapsed
+        stats['max_frame_ms'] = max(stats['max_frame_ms'], elapsed)
+        stats['avg_frame_ms'] = stats['avg_frame_ms'] * .9 + elapsed * .1
+        return count
+
+    def upload(self, decoded):
+        '''Upload a decoded tile into the atlas, or into its own texture if
+        it has an unusual size. Must be called from the main thread.'''
+        id = 'img%d' % self.uniqid
+        self.uniqid += 1
+        if self.atlas.accepts(decoded):
+            return self.atlas.upload(decoded, id)
+        texture = Texture.create(size=decoded.size, colorfmt='rgba')
+        texture.blit_buffer(decoded.pixels, colorfmt='rgba', bufferfmt='ubyte')
+        texture.flip_vertical()
+        return Tile(id, texture)
+
+    def release(self, image):
+        '''Called when a tile leaves the memory cache'''
+        if isinstance(image, AtlasTile):
+            self.atlas.release(image)
+
+    def _worker_run(self, scheduler, q_out):
         '''Internal. Main function for every worker
         '''
         do = self._worker_run_once
 
         while not self.want_close:
+            key = scheduler.pop(timeout=1)
+            if key is None:
+                continue
             try:
-                do(c_in, q_in, q_out) 
+                do(key, q_out)
             except:
+                q_out.appendleft((key, None, None))
+                self.notify()
                 Logger.exception('TileServerWorker: Unknown exception, stop the worker')
                 return
-                
-    def _worker_run_once(self, c_in, q_in, q_out):
-        '''Internal. Load one image, process, and push.
+            self.notify()
+
+    def notify(self):
+        '''Tell the viewer that tiles wait in q_out (see on_arrival)'''
+        on_arrival = self.on_arrival
+        if on_arrival is not None:
+            on_arrival()
+
+    def download(self, key):
+        '''Download a tile (nx, ny, zoom, maptype, format) into the store.
+        Return the size of the tile in bytes, or None if it could not be
+        fetched.
+
+        .. warning::
+            This function is called inside a worker Thread.
         '''
-        # get one tile to process
-        try:
-            nx, ny, zoom, maptype, format = q_in.pop()
-        except:
-            c_in.acquire()
-            c_in.wait()
-            c_in.release()
-            return
+        nx, ny, zoom, maptype, format = key
+        fid = self.to_id(nx, ny, zoom, maptype, format)
 
-        # check if the tile already have been downloaded
-        filename = self.to_filename(nx, ny, zoom, maptype, format)
-        loaded = True
-        if not isfile(filename):
-            loaded = False
-
-            # calculate the good tile index
-            tz = pow(2, zoom)
-            lx, ly = unit_to_latlon(2.0 * (nx + 0.5) / tz - 1, 1 - 2.0 * (ny + 0.5) / tz)
-            lx, ly = map(fix180, (lx, ly))
-
-            # get url for this specific tile
-            url = self.geturl(
-                nx=nx, ny=ny,
-                lx=lx, ly=ly,
-                tilew=256, tileh=256,
-                zoom=zoom,
-                format=format,
-                maptype=maptype
-            )
-
-            for i in xrange(1,3):
-              try:
-                conn = urlopen("http://%s%s" % (self.provider_host, url))
-              except Exception,ex:
-                print "ERROR IN %s/%s \n%s" % (self.provider_host, url, str(ex))
-                continue
-              
-              try:
-                  data = conn.read()
-                  conn.close()
-              except Exception, e:
-                  print 'Exception %s' % (url)
-                  Logger.error('TileServer: "%s": %s' % (str(e), filename))
-                  Logger.error('TileServer: "%s": URL=%s' % (str(e),url))
-                  continue
-            
-              # discard error messages
-              if data[:5] == "<?xml":
-                  msg = ""
-                  try: 
-                    msg = data[data.index("<ServiceException>")+18 : data.index("</ServiceException")]
-                  except:
-                    pass
-                  Logger.error('Tileserver: Received error fetching %s: %s' % (url, msg))
-                  continue
-                
-            
-              # write data on disk
-              try:
-                  directory = sep.join(filename.split(sep)[:-1])
-                  if not isdir(directory):
-                    try:
-                      mkdir(directory)
-                    except:
-                      pass # that was probably just a concurrency error - if dir is missing, all threads report it
-                  with open(filename, 'wb') as fd:
-                      fd.write(data)
-              except:
-                  Logger.exception('Tileserver: Unable to write %s' % filename)
-                  continue
+        # calculate the good tile index
+        lx, ly = unit_to_latlon(*tile_center(nx, ny, zoom))
+        lx, ly = map(fix180, (lx, ly))
+
+        # get url for this specific tile
+        url = self.geturl(
+            nx=nx, ny=ny,
+            lx=lx, ly=ly,
+            tilew=256, tileh=256,
+            zoom=zoom,
+            format=format,
+            maptype=maptype
+        )
+        if url is None: # the provider has no such tile
+            return None
+        data = self.fetch(url, fid)
+        if data is None:
+            return None
+        return self.save(key, data)
 
-              # post processing
-              self.post_download(filename)
-              loaded = True
-              break
+    def fetch(self, url, name):
+        '''Fetch `url` from the provider host, retrying once. Return the data,
+        or None on errors, including XML error documents. `name` is used in
+        the log messages.
+
+        .. warning::
+            This function is called inside a worker Thread.
+        '''
+        for i in xrange(1,3):
+          host = self.provider_host
+          try:
+              data = self.pool.fetch(host, url)
+          except Exception, e:
+              Logger.error('TileServer: "%s": %s' % (str(e), name))
+              Logger.error('TileServer: "%s": URL=http://%s%s' % (str(e), host, url))
+              continue
         
-        if not loaded:
-          return        
+          # discard error messages
+          if data[:5] == "<?xml":
+              msg = ""
+              try: 
+                msg = data[data.index("<ServiceException>")+18 : data.index("</ServiceException")]
+              except:
+                pass
+              Logger.error('Tileserver: Received error fetching %s: %s' % (url, msg))
+              continue
+          return data
+        return None
 
-        # load image
+    def save(self, key, data):
+        '''Write a downloaded tile into the store. Return its size in bytes,
+        or None if it could not be written.
+
+        .. warning::
+            This function is called inside a worker Thread.
+        '''
         try:
-          image = Loader.image(filename)
-        except Exception,e:
-          Logger.error('TileServer|HCSVNT "%s": file=%s' % (str(e), filename))
-          image = self.hcsvnt
+            self.store.write(key, data)
+            if self.janitor:
+                self.janitor.added(key, len(data))
+        except:
+            Logger.exception('Tileserver: Unable to write %s' % self.to_id(*key))
+            return None
+
+        # post processing
+        filename = self.to_filename(*key)
+        if filename is not None:
+            self.post_download(filename)
+        return len(data)
+
+    def _worker_run_once(self, key, q_out):
+        '''Internal. Load one image, process, and push.
+        '''
+        nx, ny, zoom, maptype, format = key
+        fid = self.to_id(nx, ny, zoom, maptype, format)
+        filename = self.to_filename(nx, ny, zoom, maptype, format)
+
+        # check if the tile already have been downloaded
+        if not self.store.exists(key) and self.download(key) is None:
+          q_out.appendleft((key, fid, None))
+          return
+        if self.janitor:
+          self.janitor.touch(key)
+
+        # decode image here, the main thread only uploads the pixels
+        if can_decode():
+          try:
+            image = decode_tile(self.store.read(key), format)
+            q_out.appendleft((key, fid, image))
+            return
+          except Exception,e:
+            Logger.error('TileServer|HCSVNT "%s": tile=%s' % (str(e), fid))
+            image = self.hcsvnt
+        else:
+          # no decoder available, let kivy load the image
+          try:
+            if filename is not None:
+              image = Loader.image(filename)
+            else:
+              image = Image(StringIO(self.store.read(key)), ext=format)
+              image.loaded = True
+          except Exception,e:
+            Logger.error('TileServer|HCSVNT "%s": tile=%s' % (str(e), fid))
+            image = self.hcsvnt
         image.id = 'img%d' % self.uniqid
         self.uniqid += 1
 
         # push image on the queue
-        q_out.appendleft((filename, image))
+        q_out.appendleft((key, fid, image))
 
 
 
@@ -285,12 +457,7 @@ class YahooTileServer(TileServer):
     available_maptype = dict(roadmap='Roadmap')
 
     def geturl(self, **infos):
-        def toYahoo(col, row, zoom):
-            x = col
-            y = int(pow(2, zoom - 1) - row - 1)
-            z = 18 - zoom
-            return x, y, z
-        coordinates = 'x=%d&y=%d&z=%d' % toYahoo(infos['nx'], infos['ny'], infos['zoom'])
+        coordinates = 'x=%d&y=%d&z=%d' % to_yahoo(infos['nx'], infos['ny'], infos['zoom'])
         return '/us.png.maps.yimg.com/png?v=%s&t=m&%s' % \
             ('3.52', coordinates)
 
@@ -316,22 +483,12 @@ class BingTileServer(TileServer):
     available_maptype = dict(roadmap='Roadmap', satellite='Satellite')
 
     def geturl(self, **infos):
-        octalStrings = ('000', '001', '010', '011', '100', '101', '110', '111')
-        microsoftToCorners = {'00': '0', '01': '1', '10': '2', '11': '3'}
-        def toBinaryString(i):
-            return ''.join([octalStrings[int(c)] for c in oct(i)]).lstrip('0')
-        def toMicrosoft(col, row, zoom):
-            x = col
-            y = row
-            y, x = toBinaryString(y).rjust(zoom, '0'), toBinaryString(x).rjust(zoom, '0')
-            string = ''.join([microsoftToCorners[y[c]+x[c]] for c in range(zoom)])
-            return string
         if infos['maptype'] in ('satellite', 'aerial'):
             mapprefix = 'h'
         else:
             mapprefix = 'r'
         return '/tiles/%s%s.png?g=90&shading=hill' % \
-            (mapprefix, toMicrosoft(infos['nx'], infos['ny'], infos['zoom']))
+            (mapprefix, quadkey(infos['nx'], infos['ny'], infos['zoom']))
 
     @property
     def provider_host(self):
@@ -346,8 +503,7 @@ class OpenStreetMapTileServer(TileServer):
     available_maptype = dict(roadmap='Roadmap')
 
     def geturl(self, **infos):
-        row, col, zoom = infos['nx'], infos['ny'], infos['zoom']
-        return '/%d/%d/%d.png' % (zoom, row, col)
+        return '/%(zoom)d/%(nx)d/%(ny)d.png' % infos
 
 
 #
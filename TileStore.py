@@ -0,0 +1,324 @@
+'''
+Tile storage backends for the TileServer disk cache.
+
+Tiles are keyed by (nx, ny, zoom, maptype, format), with nx/ny in tile server
+orientation (XYZ, y growing southwards).
+
+Usage for importing an existing directory cache into an MBTiles file::
+
+    python TileStore.py cache/openstreetmap cache/openstreetmap.mbtiles
+'''
+
+__all__ = ('TileStore', 'DirectoryTileStore', 'MBTilesTileStore', 'migrate')
+
+from os.path import join, isdir, isfile, sep, dirname
+from os import makedirs, mkdir, walk, stat, remove, utime
+from threading import Lock
+from time import time
+import sqlite3
+
+from tileaddress import flip_y
+
+### static configuration - TODO: parametrize ####################################
+# number of tiles buffered before they are written to the database
+MBTILES_BATCHSIZE = 64
+# maximum delay in seconds before buffered tiles are written
+MBTILES_BATCHDELAY = 2
+#################################################################################
+
+class TileStore(object):
+    '''Base implementation for a tile store. Check DirectoryTileStore and
+    MBTilesTileStore for the available backends.
+    '''
+    backend_name = 'unknown'
+    backends = dict()
+
+    @staticmethod
+    def register(cls):
+        TileStore.backends[cls.backend_name] = cls
+
+    @staticmethod
+    def create(backend, cache_path):
+        '''Create a store of the given backend name, located at `cache_path`
+        (without extension)'''
+        if backend not in TileStore.backends:
+            raise Exception('Unknown tile store %s' % backend)
+        return TileStore.backends[backend](cache_path)
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self, key):
+        '''Check if a tile is stored'''
+        raise NotImplementedError()
+
+    def read(self, key):
+        '''Return the encoded tile, or None if it is not stored'''
+        raise NotImplementedError()
+
+    def write(self, key, data):
+        '''Store an encoded tile'''
+        raise NotImplementedError()
+
+    def filename(self, key):
+        '''Return the file holding the tile, or None if the backend does not
+        store tiles as individual files'''
+        return None
+
+    def keys(self):
+        '''Iterate over all stored tile keys'''
+        raise NotImplementedError()
+
+    def scan(self):
+        '''Iterate over all stored tiles as (key, size in bytes, last access)'''
+        raise NotImplementedError()
+
+    def delete(self, keys):
+        '''Remove a batch of tiles'''
+        raise NotImplementedError()
+
+    def touch(self, times):
+        '''Record last access times, given as a dict key -> timestamp'''
+        pass
+
+    def flush(self):
+        '''Write pending tiles'''
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class DirectoryTileStore(TileStore):
+    '''One file per tile, in <path>/<first two chars of the id>/<id>.
+    This is the historical cache layout.
+    '''
+    backend_name = 'directory'
+
+    def __init__(self, path):
+        super(DirectoryTileStore, self).__init__(path)
+        if not isdir(self.path):
+            makedirs(self.path)
+
+    def to_id(self, nx, ny, zoom, maptype, format):
+        return '%d_%d_%d_%s.%s' % (nx, ny, zoom, maptype, format)
+
+    def from_id(self, fid):
+        nx, ny, zoom, rest = fid.split('_', 3)
+        maptype, format = rest.rsplit('.', 1)
+        return int(nx), int(ny), int(zoom), maptype, format
+
+    def filename(self, key):
+        fid = self.to_id(*key)
+        return join(self.path, fid[0:2], fid)
+
+    def exists(self, key):
+        return isfile(self.filename(key))
+
+    def read(self, key):
+        try:
+            with open(self.filename(key), 'rb') as fd:
+                return fd.read()
+        except IOError:
+            return None
+
+    def write(self, key, data):
+        filename = self.filename(key)
+        directory = sep.join(filename.split(sep)[:-1])
+        if not isdir(directory):
+            try:
+                mkdir(directory)
+            except:
+                pass # that was probably just a concurrency error - if dir is missing, all threads report it
+        with open(filename, 'wb') as fd:
+            fd.write(data)
+
+    def keys(self):
+        for root, dirs, files in walk(self.path):
+            for fid in files:
+                try:
+                    yield self.from_id(fid)
+                except ValueError:
+                    pass
+
+    def scan(self):
+        # the access time is kept in the file modification time (see touch),
+        # which keeps working on filesystems mounted with noatime
+        for root, dirs, files in walk(self.path):
+            for fid in files:
+                try:
+                    key = self.from_id(fid)
+                    st = stat(join(root, fid))
+                except (ValueError, OSError):
+                    continue
+                yield key, st.st_size, st.st_mtime
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                remove(self.filename(key))
+            except OSError:
+                pass
+
+    def touch(self, times):
+        for key, t in times.iteritems():
+            try:
+                utime(self.filename(key), (t, t))
+            except OSError:
+                pass
+
+
+class MBTilesTileStore(TileStore):
+    '''All tiles in one SQLite database, following the MBTiles layout (the
+    `tiles` view exposes TMS rows). Writes are buffered and committed in
+    batches, the database runs in WAL mode so that reads do not block on
+    writes.
+    '''
+    backend_name = 'mbtiles'
+
+    def __init__(self, path):
+        if not path.endswith('.mbtiles'):
+            path += '.mbtiles'
+        super(MBTilesTileStore, self).__init__(path)
+        if dirname(path) and not isdir(dirname(path)):
+            makedirs(dirname(path))
+        self.lock      = Lock()
+        self.pending   = dict()
+        self.lastflush = time()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS map (
+                zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+                maptype TEXT, format TEXT, tile_data BLOB, accessed REAL);
+            CREATE UNIQUE INDEX IF NOT EXISTS map_index
+                ON map (zoom_level, tile_column, tile_row, maptype);
+            CREATE VIEW IF NOT EXISTS tiles AS
+                SELECT zoom_level, tile_column, tile_row, tile_data FROM map;
+        ''')
+        # stores created before the janitor have no access times
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(map)')]
+        if 'accessed' not in columns:
+            self.db.execute('ALTER TABLE map ADD COLUMN accessed REAL')
+        self.db.commit()
+
+    def _row(self, key):
+        nx, ny, zoom, maptype, format = key
+        return zoom, nx, flip_y(ny, zoom), maptype
+
+    def exists(self, key):
+        with self.lock:
+            if key in self.pending:
+                return True
+            return self.db.execute('SELECT 1 FROM map WHERE zoom_level=? AND '
+                'tile_column=? AND tile_row=? AND maptype=?',
+                self._row(key)).fetchone() is not None
+
+    def read(self, key):
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            row = self.db.execute('SELECT tile_data FROM map WHERE zoom_level=? '
+                'AND tile_column=? AND tile_row=? AND maptype=?',
+                self._row(key)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def write(self, key, data):
+        with self.lock:
+            self.pending[key] = data
+            if len(self.pending) < MBTILES_BATCHSIZE and \
+               time() < self.lastflush + MBTILES_BATCHDELAY:
+                return
+            self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.lastflush = time()
+        if not self.pending:
+            return
+        now = time()
+        rows = [self._row(key) + (key[4], buffer(data), now)
+                for key, data in self.pending.iteritems()]
+        self.db.executemany('INSERT OR REPLACE INTO map (zoom_level, tile_column, '
+            'tile_row, maptype, format, tile_data, accessed) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.db.commit()
+        self.pending.clear()
+
+    def keys(self):
+        self.flush()
+        with self.lock:
+            rows = self.db.execute('SELECT zoom_level, tile_column, tile_row, '
+                'maptype, format FROM map').fetchall()
+        for zoom, nx, row, maptype, format in rows:
+            yield nx, flip_y(row, zoom), zoom, maptype, format
+
+    def scan(self):
+        self.flush()
+        with self.lock:
+            rows = self.db.execute('SELECT zoom_level, tile_column, tile_row, '
+                'maptype, format, length(tile_data), accessed FROM map').fetchall()
+        for zoom, nx, row, maptype, format, size, accessed in rows:
+            yield (nx, flip_y(row, zoom), zoom, maptype, format), size, accessed or 0
+
+    def delete(self, keys):
+        with self.lock:
+            for key in keys:
+                self.pending.pop(key, None)
+            self.db.executemany('DELETE FROM map WHERE zoom_level=? AND '
+                'tile_column=? AND tile_row=? AND maptype=?',
+                [self._row(key) for key in keys])
+            self.db.commit()
+
+    def touch(self, times):
+        with self.lock:
+            self.db.executemany('UPDATE map SET accessed=? WHERE zoom_level=? AND '
+                'tile_column=? AND tile_row=? AND maptype=?',
+                [(t, ) + self._row(key) for key, t in times.iteritems()])
+            self.db.commit()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.db.close()
+
+
+def migrate(source, target):
+    '''Copy all tiles from the `source` store into the `target` store.
+    Return the number of tiles copied.'''
+    count = 0
+    for key in source.keys():
+        if target.exists(key):
+            continue
+        data = source.read(key)
+        if data is None:
+            continue
+        target.write(key, data)
+        count += 1
+    target.flush()
+    return count
+
+
+#
+# Registers
+#
+TileStore.register(DirectoryTileStore)
+TileStore.register(MBTilesTileStore)
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3:
+        print 'Usage: python TileStore.py <cache directory> <target.mbtiles>'
+        sys.exit(1)
+    source = DirectoryTileStore(sys.argv[1])
+    target = MBTilesTileStore(sys.argv[2])
+    print 'Imported %d tiles into %s' % (migrate(source, target), target.path)
+    target.close()
@@ -1,120 +1,422 @@
 from projections import *
 from urllib2 import urlopen
 from httplib import HTTPConnection
-from threading import Thread
+from threading import Thread, Condition
+from collections import deque, OrderedDict
 from kivy.logger import Logger
 from kivy.loader import Loader
 from os.path import join, dirname
 import time, os
-import hashlib
+from math import floor
+from array import array
 
-GMLNS = "http://www.opengis.net/gml"
+from gmlparser import GMLNS, ProgressReader, iterfeatures
+from tileaddress import tile_bounds
+from simplify import ranks
+from featurestore import FeatureStore, feature_key
+from featurecache import FeatureDiskCache
+from spatialindex import GridIndex, bbox_of, point_in_ring
 
 try:
-    from pyproj import Proj
-    from lxml.etree import ElementTree as ET 
-except:
-#    try: 
-        from xml.etree import ElementTree as ET
-#    except:
-#        pass
+    from xml.etree import cElementTree as ET
+except ImportError:
+    from xml.etree import ElementTree as ET
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+### static configuration - TODO: parametrize ####################################
+# features requested at most per GetFeature
+WFS_MAXFEATURES = 50
+# cells of the hit-testing index across the first area loaded
+WFS_INDEX_CELLS = 32
+# features are loaded by cells, the tiles of the zoom level rounded down to
+# a multiple of WFS_ZOOM_BAND
+WFS_ZOOM_BAND = 2
+# a cell that returns maxFeatures features is split in 4, at most this deep
+WFS_MAX_SPLIT = 4
+# seconds before a cell that failed to load is requested again, doubled on
+# every failure up to WFS_RETRY_MAX
+WFS_RETRY_DELAY = 15
+WFS_RETRY_MAX = 15 * 60
+# memory of the loaded features, beyond which the cells least recently in
+# view are dropped
+WFS_STORE_BUDGET = 16 * 1024 * 1024
+# disk cache of the features, shared by the WFS overlays (None to disable)
+WFS_DISKCACHE = join(dirname(__file__), 'cache', 'wfs.sqlite')
+#################################################################################
 
 class WFSOverlayServer(object):
-    cache = {} 
     available_maptype = dict(roadmap = 'Roadmap') # default
     type = "wfs" # TODO: replace handling in mapviewer with action handlers in the overlay class
  
-    def __init__(self, progress_callback=None):    
+    def __init__(self, progress_callback=None, diskcache=WFS_DISKCACHE):    
       self.progress_callback = progress_callback
+      self.diskcache_path = diskcache
+      self.diskcache = None
+      self.index = None
+      self.store = FeatureStore()
+      self.cells = OrderedDict()  # (x, y, zoom) -> rows of its features, least recently used first
+      self.truncated = set()  # cells that returned maxFeatures features
+      self.failed = {}        # cell -> (time of its next request, failures), for the cells that failed
+      self.retry_at = None    # next request of a failed cell in view
+      self.byid = {}          # feature key -> row
+      self.used = set()       # cells used by the last get(), or loaded since
+      self.compact_at = WFS_STORE_BUDGET
+      self.queue = []         # cells to load, next one last
+      self.loading = set()
+      self.condition = Condition()
+      self.q_out = deque()    # (cell, features or None, truncated) loaded by the worker
+      self.worker = None
+      self.on_arrival = None  # called from the worker when q_out grows
+      self.visible = (None, None)
       
     def setProgressCallback(self, progress_callback):
       self.progress_callback = progress_callback
 
-    def load(self, url):
-        # read from internet
-        blocksize = 4096
-        self.progress_callback(0)
-        fd = urlopen(url)
-        idata = fd.read(blocksize)
-        loaded = blocksize
-        while True:
-          bdata = fd.read(blocksize)
-          if not bdata: break
-          loaded += blocksize
-          if self.progress_callback:
-              self.progress_callback(loaded)
-          idata += bdata
+    def progress(self, loaded):
+      if self.progress_callback:
+        self.progress_callback(loaded)
+
+    def features(self, url, progress=True):
+      '''Yield the features of a GetFeature url as they are read from the
+      network: the response is never held in memory as a whole'''
+      callback = progress and self.progress_callback or None
+      if callback:
+        callback(0)
+      fd = urlopen(url)
+      try:
+        for feature in iterfeatures(ProgressReader(fd, callback)):
+          yield feature
+      finally:
         fd.close()
-        self.progress_callback(-1)
-        return idata
-
-    def findGeometry(self, elem):
-        geoms = elem.find("{%s}Point" % GMLNS)
-        if geoms is not None:
-            return geoms
-        geoms = elem.find("{%s}LinearRing" % GMLNS)
-        if geoms is not None:
-            return geoms
-        for c in elem.getchildren():
-            geom = self.findGeometry(c)
-            if geom is not None:
-                return geom
-                    
-    def findGeometries(self, members):
-        geoms = []
-        for m in members:
-            geom = self.findGeometry(m)
-            if geom is not None:
-                geoms.append(geom)
-        return geoms
-        
+        if callback:
+          callback(-1)
+
+    def cell_box(self, cell):
+      '''Return the lat/lon box (lat1, lon1, lat2, lon2) of a cell'''
+      west, south, east, north = tile_bounds(*cell)
+      lat1, lon1 = unit_to_latlon(west, south)
+      lat2, lon2 = unit_to_latlon(east, north)
+      return lat1, lon1, lat2, lon2
+
+    def view_cells(self, parent):
+      '''Return the cells covering the viewport of the map viewer'''
+      zoom = max(parent.zoom - parent.zoom % WFS_ZOOM_BAND, 0)
+      tz = 1 << zoom
+      x1, y1, x2, y2 = parent.viewport_fractions()
+      xs = xrange(int(floor(x1 * tz)), int(floor(x2 * tz)) + 1)
+      ys = xrange(max(int(floor(y1 * tz)), 0), min(int(floor(y2 * tz)), tz - 1) + 1)
+      if len(xs) > tz:
+        xs = xrange(tz)
+      cells = []
+      for x in xs:
+        for y in ys:
+          if (x % tz, y, zoom) not in cells:
+            cells.append((x % tz, y, zoom))
+      return cells
+
+    def resolve(self, cell, rows, missing, depth=0):
+      '''Add the feature rows of a cell to `rows`, from its children if the
+      cell was truncated and they are all loaded. Cells to load are added to
+      `missing`.'''
+      if cell not in self.cells:
+        missing.append(cell)
+        return False
+      self.used.add(cell)
+      self.cells[cell] = self.cells.pop(cell)
+      if cell in self.failed:
+        retry = self.failed[cell][0]
+        if time.time() >= retry:
+          missing.append(cell)
+        else:
+          self.retry_at = min(self.retry_at or retry, retry)
+      if cell in self.truncated and depth < WFS_MAX_SPLIT:
+        x, y, zoom = cell
+        children = [(2 * x + i, 2 * y + j, zoom + 1) for j in (0, 1) for i in (0, 1)]
+        found = []
+        if all([self.resolve(child, found, missing, depth + 1) for child in children]):
+          rows.extend(found)
+          return True
+      rows.extend(self.cells[cell])
+      return True
+
     def get(self, parent, width, height): 
+      '''Return the features loaded in the viewport of the map viewer
+      `parent`, and queue the loading of the cells still missing'''
       self.bl = parent.bottom_left
       self.tr = parent.top_right
       self.zoom = parent.zoom
-      
-      url = self.geturl(self.bl[0], self.bl[1], self.tr[0], self.tr[1])
-      if not url:
-        return None
 
-      key = hashlib.md5(url).hexdigest()
-      if key in self.cache:
-        return self.cache[key]
+      changed = self.update()
+      cells = self.view_cells(parent)
+      retry = self.retry_at is not None and time.time() >= self.retry_at
+      if changed or retry or self.visible[0] != cells:
+        rows, missing = [], []
+        self.used = set()
+        self.retry_at = None
+        for cell in cells:
+          self.resolve(cell, rows, missing)
+        kinds = self.store.kinds
+        features = [self.store.feature(row) for row in sorted(set(rows)) if kinds[row]]
+        self.visible = (cells, features)
+        self.request(missing)
+      self.geometries = self.visible[1]
+      return self.geometries
+
+    def pending(self):
+      '''Return True while cells are queued or loading, or failed cells in
+      view wait to be requested again'''
+      return bool(self.queue or self.loading or self.q_out or self.retry_at)
+
+    def update(self):
+      '''Store the cells loaded by the worker. Return True if any.'''
+      changed = False
+      while self.q_out:
+        cell, features, truncated = self.q_out.pop()
+        with self.condition:
+          self.loading.discard(cell)
+        changed = True
+        if features is None:
+          # failed: keep it empty for now, request it again after a delay
+          failures = self.failed.get(cell, (None, 0))[1] + 1
+          delay = min(WFS_RETRY_DELAY * 2 ** (failures - 1), WFS_RETRY_MAX)
+          self.failed[cell] = (time.time() + delay, failures)
+          self.cells[cell] = array('l')
+          continue
+        self.failed.pop(cell, None)
+        rows, added = array('l'), []
+        for feature in features:
+          key = feature_key(feature)
+          row = self.byid.get(key)
+          if row is None:
+            row = self.byid[key] = self.store.add(feature)
+            added.append(row)
+          rows.append(row)
+        self.cells[cell] = rows
+        self.used.add(cell)
+        if truncated:
+          self.truncated.add(cell)
+        self.index_cell(cell, added)
+      if changed and self.store.nbytes > self.compact_at:
+        self.compact()
+      return changed
+
+    def compact(self):
+      '''Drop the cells least recently used, out of view, until the features
+      fit in 3/4 of the budget, and copy the features left into a new store'''
+      store = self.store
+      size = float(store.nbytes) / max(len(store), 1)  # per row
+      budget = WFS_STORE_BUDGET * 3 / 4
+      total = sum(len(rows) for rows in self.cells.itervalues()) * size
+      for cell in self.cells.keys():
+        if total <= budget:
+          break
+        if cell not in self.used:
+          total -= len(self.cells.pop(cell)) * size
+          self.truncated.discard(cell)
+          self.failed.pop(cell, None)
+
+      self.store = FeatureStore()
+      self.byid = {}
+      moved = {}
+      for cell, rows in self.cells.items():
+        new = array('l')
+        for row in rows:
+          if row not in moved:
+            moved[row] = self.store.copy(store, row)
+            self.byid[feature_key(self.store.feature(moved[row]))] = moved[row]
+          new.append(moved[row])
+        self.cells[cell] = new
+      Logger.info('WFSOverlayServer: kept %d features out of %d in %d cells' % (
+          len(self.store), len(store), len(self.cells)))
+      # if the cells in view alone exceed the budget, let them grow first
+      self.compact_at = max(WFS_STORE_BUDGET, 2 * self.store.nbytes)
+
+      # the views held by the index and the feature list are stale now
+      if self.index is not None:
+        self.index = GridIndex(self.index.cellsize)
+      for cell, rows in self.cells.items():
+        if cell not in self.failed:  # never loaded: not covered
+          self.index_cell(cell, rows)
+      self.visible = (None, None)
+
+    def request(self, cells):
+      '''Replace the queue of cells to load: cells out of view are dropped'''
+      with self.condition:
+        self.queue = [cell for cell in reversed(cells) if cell not in self.loading]
+        self.condition.notify()
+      if self.queue and self.worker is None:
+        self.worker = Thread(target=self._worker_run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _worker_run(self):
+      while True:
+        with self.condition:
+          while not self.queue:
+            self.condition.wait()
+          cell = self.queue.pop()
+          self.loading.add(cell)
+        try:
+          features, truncated = self.load_cell(cell)
+        except Exception, e:
+          # never let the only worker die: report the cell as failed
+          Logger.error('OverlayServer could not load WFS cell %s [%s]' % (cell, e))
+          features, truncated = None, False
+        self.q_out.appendleft((cell, features, truncated))
+        on_arrival = self.on_arrival
+        if on_arrival is not None:
+          on_arrival()
 
+    def load_cell(self, cell):
+      '''Return the features of a cell and whether they were truncated, from
+      the disk cache if it holds them and they are fresh, else from the
+      server. Stale features are still used if the server cannot be reached.
+      Runs in the worker thread.'''
+      lat1, lon1, lat2, lon2 = self.cell_box(cell)
+      cached = None
+      if self.diskcache_path:
+        try:
+          if self.diskcache is None:
+            self.diskcache = FeatureDiskCache(self.diskcache_path)
+          area = self.get_area(lat1, lon1, lat2, lon2)
+          cached = self.diskcache.read_cell(self.layer_key(), cell, area, self.maxfeatures)
+        except Exception, e:
+          Logger.error('OverlayServer cannot read the WFS disk cache [%s]' % e)
+      if cached is not None and cached[2]:
+        return cached[0], cached[1]
+
+      url = None
       try:
-        xml = self.load('http://' + self.provider_host + url)
-        
-        tree = ET.fromstring(xml)
-        members = tree.findall("{%s}featureMember" % GMLNS)
-        
-        self.geometries = self.findGeometries(members)
-        self.cache[key] = self.geometries
-        return self.geometries
-        
+        url = self.geturl(lat1, lon1, lat2, lon2)
+        if url:
+          features = list(self.features('http://' + self.provider_host + url, progress=False))
+          for feature in features:
+            self.project(feature)
+          truncated = len(features) >= self.maxfeatures
+          self.save_cell(cell, features, truncated)
+          return features, truncated
       except Exception,e:
         Logger.error('OverlayServer could not find (or read) WFS from %s [%s]' % (url, e))
-        image = None
+      if cached is not None:
+        return cached[0], cached[1]  # offline: stale is better than nothing
+      return None, False
+
+    def save_cell(self, cell, features, truncated):
+      '''Store the features fetched for a cell in the disk cache. A failure
+      is only logged: the features are used anyway.'''
+      if self.diskcache is None:
+        return
+      try:
+        area = self.get_area(*self.cell_box(cell))
+        self.diskcache.write_cell(self.layer_key(), cell, features, truncated, area)
+      except Exception, e:
+        Logger.error('OverlayServer cannot write the WFS disk cache [%s]' % e)
+
+    def layer_key(self):
+      '''Return the key of the features in the disk cache'''
+      return '%s|%s|%s' % (self.provider_host, self.feature, self.srs)
+
+    def project(self, feature):
+      '''Set the coordinates of a feature in the unit square, and rank them
+      for the levels of detail of the rings, for drawing. With numpy, all
+      the coordinates of the feature are converted in one call.'''
+      coords = feature.coords
+      xs, ys = coords[0:len(coords) - 1:2], coords[1::2]
+      unit = array('f')
+      if numpy is not None and xs:
+        us, vs = self.co_to_unit(xs, ys)
+        unit.fromstring(numpy.column_stack((us, vs)).astype('f').tostring())
+      else:
+        for x, y in zip(xs, ys):
+          unit.extend(self.co_to_unit(x, y))
+      feature.unit = unit
+      if feature.kind == "LinearRing":
+        feature.ranks = ranks(unit)
 
-    def getInfoText(self, member):
-      fields = member.getchildren()[0].getchildren()
+    def co_to_unit(self, x, y):
+      '''Return the unit square coordinates of x/y (scalars or arrays) in the
+      coordinates of the features'''
+      if self.customBounds or self.isPLatLon or self.isPGoogle:
+        lat, lon = self.co_to_ll(x, y)
+        return latlon_to_unit(lat, fix180(lon))
+      return srs_to_unit(self.srs, x, y)
+
+    def getInfoText(self, feature):
       info = ""
-      for field in fields:
-        if field.text is not None and field.text.strip() != "":
-          info += "%s: %s\n" % (field.tag[field.tag.index("}")+1:], field.text)
+      for name, text in feature.attributes:
+        info += "%s: %s\n" % (name, text)
       return info
         
+    def get_area(self, lat1, lon1, lat2, lon2):
+      '''Return the area (xmin, ymin, xmax, ymax) of a lat/lon box, in the
+      coordinates of the features'''
+      x1, y1 = self.xy_to_co(lat1, lon1)
+      x2, y2 = self.xy_to_co(lat2, lon2)
+      return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+    def index_cell(self, cell, rows):
+      '''Index the features of a loaded cell, for getInfo. The cell only
+      counts as covered if its response was not truncated.'''
+      lat1, lon1, lat2, lon2 = self.cell_box(cell)
+      try:
+        area = self.get_area(lat1, lon1, lat2, lon2)
+      except RuntimeError:
+        return
+      if self.index is None:
+        self.index = GridIndex(max(area[2] - area[0], area[3] - area[1]) / float(WFS_INDEX_CELLS) or 1.)
+      offsets = self.store.offsets
+      for row in rows:
+        if offsets[row + 1] > offsets[row]:
+          feature = self.store.feature(row)
+          self.index.insert(row, feature.bbox(), feature)
+      if cell not in self.truncated:
+        self.index.cover(area)
+
+    def hit(self, area):
+      '''Return the indexed feature hit by a touch on `area`: the point
+      nearest to its centre, else a ring containing its centre or one of
+      whose vertices lies in it'''
+      cx, cy = (area[0] + area[2]) / 2., (area[1] + area[3]) / 2.
+      best, distance = None, None
+      for bbox, feature in self.index.query(area):
+        if feature.kind == "Point":
+          d = (feature.coords[0] - cx) ** 2 + (feature.coords[1] - cy) ** 2
+          if distance is None or d < distance:
+            best, distance = feature, d
+      if best is not None:
+        return best
+      for bbox, feature in self.index.query(area):
+        if feature.kind == "LinearRing":
+          coords = feature.coords
+          if point_in_ring(cx, cy, coords):
+            return feature
+          for i in xrange(0, len(coords) - 1, 2):
+            if area[0] <= coords[i] <= area[2] and area[1] <= coords[i + 1] <= area[3]:
+              return feature
+      return None
+
     def getInfo(self, lat, lon, epsilon):
       try:
         url = self.geturl(lat-epsilon, lon-epsilon, lat+epsilon, lon+epsilon)
       except:
         return None
+      # answer from the features already loaded if they cover the touch
+      if self.index is not None:
+        try:
+          area = self.get_area(lat-epsilon, lon-epsilon, lat+epsilon, lon+epsilon)
+        except RuntimeError:
+          area = None
+        if area is not None and self.index.covers(area):
+          feature = self.hit(area)
+          return self.getInfoText(feature) if feature is not None else None
       try:
-        xml = self.load('http://' + self.provider_host + url)
-        tree = ET.fromstring(xml)
-        member = tree.find("{%s}featureMember" % GMLNS)
-        if member is not None:
-          infotext = self.getInfoText(member)
-          return infotext
+        # only the first feature is needed: stop reading there
+        for feature in self.features('http://' + self.provider_host + url):
+          return self.getInfoText(feature)
       except Exception,e:
         Logger.error('OverlayServer could not find (or read) WFS from %s [%s]' % (url, e))
       return None
@@ -127,7 +429,7 @@ class WFSOverlayServer(object):
       elif self.isPGoogle: # patch for android - does not require pyproj library
         x, y = latlon_to_google (lat, lon)
       else:
-        x, y = transform(pLatlon, self.projection, lon, lat)
+        x, y = reprojection('EPSG:4326', self.srs)(lon, lat)  # per thread
       return x,y
 
     def co_to_ll(self,x,y):
@@ -138,7 +440,7 @@ class WFSOverlayServer(object):
       elif self.isPGoogle: # patch for android - does not require pyproj library
         l, m = google_to_latlon (y, x)
       else:
-        l, m = transform(self.projection, pLatlon, y, x)
+        l, m = reprojection(self.srs, 'EPSG:4326')(y, x)  # per thread
       return l, m
       
     def geturl(self, lat1, lon1, lat2, lon2):
@@ -186,19 +488,22 @@ class WFSOverlayServer(object):
       
       # generate tile URL and init projection by EPSG code
       self.feature = feature
-      self.url = baseurl + "?typeName=namespace:%s&SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature&maxFeatures=50" % (feature)
+      self.srs = srs
+      self.maxfeatures = WFS_MAXFEATURES
+      self.url = baseurl + "?typeName=namespace:%s&SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature&maxFeatures=%d" % (
+          feature, self.maxfeatures)
       self.isPGoogle = False
       self.isPLatLon = False
       if srs=="EPSG:4326":
         self.isPLatLon = True
       elif srs=="EPSG:900913" or srs == "EPSG:3857":
         self.isPGoogle = True
-        try:
-          self.projection = pGoogle
-        except:
-          pass
       else:
+        # reprojection() is looked up at each use: its cache is per thread,
+        # and the workers reproject too. Build this thread's pair now to
+        # report an unknown SRS early.
         try:
-          self.projection = Proj(init=srs)
-        except:
-          pass
\ No newline at end of file
+          reprojection('EPSG:4326', srs)
+          reprojection(srs, 'EPSG:4326')
+        except Exception, e:
+          Logger.error('OverlayServer cannot reproject to %s [%s]' % (srs, e))
\ No newline at end of file
@@ -5,19 +5,51 @@ from threading import Thread
 from kivy.logger import Logger
 from kivy.loader import Loader
 from os.path import join, dirname
+from math import floor, ceil, log
 import time, os
 import hashlib
 
+from tilecache import TileMemoryCache
+from WMSTileServer import WMSTileServer
+
 try: 
-  from pyproj import Proj
   from xml.etree import ElementTree as ET
 except:
   pass
 
+### static configuration - TODO: parametrize ####################################
+# memory budget for the viewport images of an overlay
+WMSOVERLAY_CACHE_BUDGET = 32 * 1024 * 1024
+# requested areas are snapped to a grid of 1/WMSOVERLAY_SNAP of the viewport
+WMSOVERLAY_SNAP = 4
+# largest image requested, in pixels per side (WMS MaxWidth/MaxHeight and
+# GL_MAX_TEXTURE_SIZE of mobile GPUs): larger areas are requested at a lower
+# resolution
+WMSOVERLAY_MAX_SIZE = 2048
+#################################################################################
+
+class WMSOverlayTileServer(WMSTileServer):
+    '''Tiles of a tiled WMS overlay (see WMSOverlayServer.tiled), fetched and
+    cached like the base map tiles, in their own cache directory'''
+
+    def __init__(self, overlay, **kwargs):
+      self.provider_name = 'overlay-%s' % hashlib.md5(
+          overlay.provider_host + overlay.baseurl + overlay.layer).hexdigest()[:12]
+      self.provider_host = overlay.provider_host
+      self.url = overlay.baseurl + "?SRS=%s&FORMAT=image/png&TRANSPARENT=TRUE&SERVICE=WMS&VERSION=1.1.1&REQUEST=GetMap&STYLES=" % overlay.srs
+      self.srs = overlay.srs
+      self.customBounds = getattr(overlay, 'customBounds', False)
+      self.bounds = getattr(overlay, 'bounds', None)
+      self.isPLatLon = overlay.isPLatLon
+      self.isPGoogle = overlay.isPGoogle
+      super(WMSOverlayTileServer, self).__init__(**kwargs)
+
 class WMSOverlayServer(object):
-    cache = {} 
     available_maptype = dict(roadmap = 'Roadmap') # default
     type = "wms"
+    tiled = False   # draw the overlay with tiles, see tileserver
+    images = None   # viewport images, see get
+    _tileserver = None
  
     '''Generic WMS server'''
     def __init__(self, progress_callback=None):    
@@ -28,28 +60,61 @@ class WMSOverlayServer(object):
     
     def getInfo(self, lat, lon, epsilon):
       return None
+
+    @property
+    def tileserver(self):
+      '''The TileServer of a tiled overlay, started on first use'''
+      if self._tileserver is None:
+        self._tileserver = WMSOverlayTileServer(self)
+        self._tileserver.start()
+      return self._tileserver
+
+    def stop(self):
+      '''Stop the workers of the tile server of a tiled overlay, e.g. when the
+      overlay is removed. It is started again on next use.'''
+      if self._tileserver is not None:
+        self._tileserver.stop()
+        self._tileserver = None
     
     def get(self, parent, width, height): 
-    
-      self.bl = parent.bottom_left
-      self.tr = parent.top_right
+      '''Return the image covering the viewport of `parent`, a MapViewerPlane
+      of `width` x `height` pixels. The requested area is snapped to a grid of
+      a fraction of the viewport and extended by one cell, so that small pans
+      reuse the same image. The area covered, in plane coordinates, is set on
+      the image as `area` = (pos, size).'''
       self.zoom = parent.zoom
-      
-      url = self.geturl(self.bl[0], self.bl[1], self.tr[0], self.tr[1], self.zoom, width, height)
+      (minx, miny), (maxx, maxy) = parent.omin, parent.omax
+      if maxx <= minx or maxy <= miny:
+        return None
+      step = pow(2, floor(log((maxx - minx) / WMSOVERLAY_SNAP, 2)))
+      x1, y1 = (floor(minx / step) - 1) * step, (floor(miny / step) - 1) * step
+      x2, y2 = (ceil(maxx / step) + 1) * step, (ceil(maxy / step) + 1) * step
+      w = int(round(width * (x2 - x1) / (maxx - minx)))
+      h = int(round(height * (y2 - y1) / (maxy - miny)))
+      scale = min(1., float(WMSOVERLAY_MAX_SIZE) / max(w, h, 1))
+      w, h = int(w * scale), int(h * scale)
+
+      self.bl = parent.get_latlon_from_local(x1, y1)
+      self.tr = parent.get_latlon_from_local(x2, y2)
+      url = self.geturl(self.bl[0], self.bl[1], self.tr[0], self.tr[1], self.zoom, w, h)
       if not url:
         return None
 
-      key = hashlib.md5(url).hexdigest()
-        
-      if key in self.cache:
-        return self.cache[key]
-        
-      try:
-        image = Loader.image('http://' + self.provider_host + url, progress_callback = self.progress_callback)
-        self.cache[key] = image
-      except Exception,e:
-        Logger.error('OverlayServer could not find (or read) image %s [%s]' % (url, e))
-        image = None
+      if self.images is None:
+        self.images = TileMemoryCache(WMSOVERLAY_CACHE_BUDGET)
+      # pin the new image first, so that storing it evicts the previous one
+      # rather than itself
+      self.images.pin([url])
+      image = self.images.get(url)
+      if image is None:
+        try:
+          image = Loader.image('http://' + self.provider_host + url, progress_callback = self.progress_callback)
+        except Exception,e:
+          Logger.error('OverlayServer could not find (or read) image %s [%s]' % (url, e))
+          return None
+        image.area = ((x1, y1), (x2 - x1, y2 - y1))
+        self.images.put(url, image, w * h * 4)
+      return image
         
     def getLegendGraphic(self):
       if self.legend is None and not self.triedlegend:
@@ -76,7 +141,7 @@ class WMSOverlayServer(object):
       elif self.isPGoogle: # patch for android - does not require pyproj library
         x, y = latlon_to_google (lat, lon)
       else:
-        x, y = transform(pLatlon, self.projection, lon, lat)
+        x, y = reprojection('EPSG:4326', self.srs)(lon, lat)  # per thread
       return x,y
 
     def co_to_ll(self, x,y):
@@ -88,7 +153,7 @@ class WMSOverlayServer(object):
       elif self.isPGoogle: # patch for android - does not require pyproj library
         l, m = google_to_latlon (y, x)
       else:
-        l, m = transform(self.projection, pLatlon, y, x)
+        l, m = reprojection(self.srs, 'EPSG:4326')(y, x)  # per thread
       return l, m
       
     def geturl(self, lat1, lon1, lat2, lon2, zoom, w, h):
@@ -139,6 +204,7 @@ class WMSOverlayServer(object):
       # generate tile URL and init projection by EPSG code
       self.layer = layer
       self.baseurl = baseurl
+      self.srs = srs
       self.url = baseurl + "?LAYERS=%s&SRS=%s&FORMAT=image/png&TRANSPARENT=TRUE&SERVICE=WMS&VERSION=1.1.1&REQUEST=GetMap&STYLES=" % (layer, srs)
       self.isPGoogle = False
       self.isPLatLon = False
@@ -149,12 +215,12 @@ class WMSOverlayServer(object):
         self.isPLatLon = True
       elif srs=="EPSG:900913" or srs == "EPSG:3857":
         self.isPGoogle = True
-        try:
-          self.projection = pGoogle
-        except:
-          pass
       else:
+        # reprojection() is looked up at each use: its cache is per thread,
+        # and the workers reproject too. Build this thread's pair now to
+        # report an unknown SRS early.
         try:
-          self.projection = Proj(init=srs)
-        except:
-          pass
\ No newline at end of file
+          reprojection('EPSG:4326', srs)
+          reprojection(srs, 'EPSG:4326')
+        except Exception, e:
+          Logger.error('OverlayServer cannot reproject to %s [%s]' % (srs, e))
\ No newline at end of file
@@ -1,33 +1,132 @@
 from TileServer import *
+from urllib2 import urlopen
 from projections import *
+from tileaddress import tile_bounds
+from tiledecoder import slice_tiles, can_slice
+from threading import Event, Lock
 
 try:
-  from pyproj import Proj
   from xml.etree import ElementTree as ET
 except:
   pass
 
+### static configuration - TODO: parametrize ####################################
+# tiles per side of the blocks requested in one GetMap (1 disables metatiling),
+# only for SRS linear in the unit square
+WMS_METATILE = 4
+# seconds a worker waits for a block fetched by another worker
+WMS_METATILE_TIMEOUT = 60
+#################################################################################
+
+class MetaFetch(object):
+    '''A block of tiles being fetched, other workers wait on `done`'''
+    __slots__ = ('done', 'sizes')
+
+    def __init__(self):
+        self.done  = Event()
+        self.sizes = dict()  # key -> size of the tiles written
+
 class WMSTileServer(TileServer):
-    '''Generic WMS tile server (see below for extending it to a specific provider)'''
+    '''Generic WMS tile server (see below for extending it to a specific provider)
+
+    With `metatile` > 1, tiles are requested by blocks of metatile x metatile
+    tiles in one GetMap, sliced by the worker and all written to the cache.
+    This saves the server's per request setup and keeps labels whole across
+    tile edges. Workers asking for tiles of a block already being fetched
+    wait for it instead of sending their own request.
+
+    Blocks are sliced into equal pixel rows and columns, which is only right
+    if the SRS is linear in the unit square (EPSG:3857, EPSG:4326 and custom
+    bounds). Other SRS (EPSG:32633, ...) are requested tile by tile.
+    '''
+    isPLatLon = False
+    isPGoogle = False
+
+    def __init__(self, metatile=WMS_METATILE, **kwargs):
+      super(WMSTileServer, self).__init__(**kwargs)
+      self.metatile = can_slice() and metatile or 1
+      self.metalock = Lock()
+      self.metafetches = dict()  # key of the block -> MetaFetch
+
     def geturl(self, nx, ny, lx, ly, tilew, tileh, zoom, format, maptype):
-      tz = pow(2, zoom)
-      
+      west, south, east, north = tile_bounds(nx, ny, zoom)
+      return self.getmapurl(west, south, east, north, tilew, tileh, maptype)
+
+    def getmapurl(self, west, south, east, north, width, height, maptype):
+      '''Return the GetMap url of an area of the unit square'''
       if self.customBounds:
-        ulx, uly, orx, ory = self.bounds
-        dx, dy = orx-ulx, ory-uly
-        x1 = ulx + dx * nx / tz
-        x2 = ulx + dx * (nx+1.0) / tz
-        y1 = uly + dy * (1.0 - (ny + 1.0) / tz)
-        y2 = uly + dy * (1.0 - (ny + 0.0) / tz)
-        return self.url + "&BBOX=%f,%f,%f,%f&WIDTH=256&HEIGHT=256&LAYERS=%s" % (x1, y1, x2, y2, maptype)
+        x1, y1 = unit_to_custom(west, south, self.bounds)
+        x2, y2 = unit_to_custom(east, north, self.bounds)
+        return self.url + "&BBOX=%f,%f,%f,%f&WIDTH=%d&HEIGHT=%d&LAYERS=%s" % (x1, y1, x2, y2, width, height, maptype)
 
       if self.isPLatLon:
-        y1, x1 = unit_to_p4326(1 - 2.0 * (ny) / tz, 2.0 * (nx) / tz - 1)
-        y2, x2 = unit_to_p4326(1 - 2.0 * (ny + 1.0) / tz, 2.0 * (nx + 1.0) / tz - 1)
+        y1, x1 = unit_to_p4326(north, west)
+        y2, x2 = unit_to_p4326(south, east)
+      elif self.isPGoogle: # linear in the unit square, does not require pyproj
+        x1, y1 = west * GCONST, north * GCONST
+        x2, y2 = east * GCONST, south * GCONST
       else:
-        x1, y1 = unit_to_project(self.projection, 2.0 * (nx) / tz - 1, 1 - 2.0 * (ny) / tz)
-        x2, y2 = unit_to_project(self.projection, 2.0 * (nx + 1.0) / tz - 1, 1 - 2.0 * (ny + 1.0) / tz)
-      return self.url + "&BBOX=%f,%f,%f,%f&WIDTH=256&HEIGHT=256&LAYERS=%s" % (x1, y2, x2, y1, maptype)
+        x1, y1 = unit_to_srs(self.srs, west, north)
+        x2, y2 = unit_to_srs(self.srs, east, south)
+      return self.url + "&BBOX=%f,%f,%f,%f&WIDTH=%d&HEIGHT=%d&LAYERS=%s" % (x1, y2, x2, y1, width, height, maptype)
+
+    def is_linear(self):
+      '''Return True if the SRS is linear in the unit square, so that the
+      tiles of a block are equal parts of its image'''
+      return bool(self.customBounds or self.isPLatLon or self.isPGoogle)
+
+    def download(self, key):
+      '''Download the block holding a tile, or wait for the worker already
+      downloading it. Return the size of the tile, or None.
+
+      .. warning::
+          This function is called inside a worker Thread.
+      '''
+      if self.metatile <= 1 or not self.is_linear():
+        return super(WMSTileServer, self).download(key)
+      nx, ny, zoom, maptype, format = key
+      n = min(self.metatile, 1 << zoom)
+      block = (nx - nx % n, ny - ny % n, zoom, maptype, format)
+
+      with self.metalock:
+        fetch = self.metafetches.get(block)
+        owner = fetch is None
+        if owner:
+          fetch = self.metafetches[block] = MetaFetch()
+      if not owner:
+        fetch.done.wait(WMS_METATILE_TIMEOUT)
+        return fetch.sizes.get(key)
+
+      try:
+        fetch.sizes = self.download_block(block, n)
+      finally:
+        fetch.done.set()
+        with self.metalock:
+          del self.metafetches[block]
+      return fetch.sizes.get(key)
+
+    def download_block(self, block, n):
+      '''Fetch n x n tiles from the top left tile `block` in one GetMap, and
+      write them all to the store. Return {key: size} of the tiles written.'''
+      bx, by, zoom, maptype, format = block
+      west, south, east, north = tile_bounds(bx, by, zoom)
+      west2, south2, east2, north2 = tile_bounds(bx + n - 1, by + n - 1, zoom)
+      url = self.getmapurl(west, south2, east2, north, 256 * n, 256 * n, maptype)
+      data = self.fetch(url, 'block %s' % self.to_id(*block))
+      if data is None:
+        return {}
+      try:
+        tiles = slice_tiles(data, n, n)
+      except Exception, e:
+        Logger.error('WMSTileServer: cannot slice block %s [%s]' % (self.to_id(*block), e))
+        return {}
+      sizes = {}
+      for (col, row), tile in tiles.iteritems():
+        key = (bx + col, by + row, zoom, maptype, format)
+        size = self.save(key, tile)
+        if size is not None:
+          sizes[key] = size
+      return sizes
       
     def initFromGetCapabilities(self, host, baseurl, index = 0, srs = None, layer = None):
       # GetCapabilities (Layers + SRS)
@@ -54,13 +153,12 @@ class WMSTileServer(TileServer):
       # generate tile URL and init projection by EPSG code
       self.url = baseurl + "?SRS=%s&FORMAT=image/png&SERVICE=WMS&VERSION=1.1.1&REQUEST=GetMap" % (srs)
       self.isPLatLon = False
-      try:
-        if srs == "EPSG:4326":  # android patches for common projections
-          self.isPLatLon = True
-        else:
-          self.projection = Proj(init=srs)
-      except:
-        pass
+      self.isPGoogle = False
+      self.srs = srs
+      if srs == "EPSG:4326":  # android patches for common projections
+        self.isPLatLon = True
+      elif srs in ("EPSG:900913", "EPSG:3857"):
+        self.isPGoogle = True
 
 class OSMWMSTileServer(WMSTileServer):
     '''Connect to OSM-WMS worldwide tile service
@@ -72,6 +170,6 @@ class OSMWMSTileServer(WMSTileServer):
 
     def __init__(self, **kwargs):
       self.initFromGetCapabilities('http://129.206.229.158', '/cached/osm', index=1)
-      super(WMSTileServer, self).__init__(**kwargs) 
+      super(OSMWMSTileServer, self).__init__(**kwargs) 
 
 TileServer.register(OSMWMSTileServer)    
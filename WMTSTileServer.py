@@ -0,0 +1,187 @@
+from TileServer import *
+from urllib2 import urlopen
+from projections import GCONST
+from urlparse import urlsplit
+from math import log
+
+try:
+  from xml.etree import ElementTree as ET
+except:
+  pass
+
+### static configuration - TODO: parametrize ####################################
+# namespaces of WMTS 1.0.0 capabilities
+WMTS_NS = {'wmts': 'http://www.opengis.net/wmts/1.0',
+           'ows': 'http://www.opengis.net/ows/1.1',
+           'xlink': 'http://www.w3.org/1999/xlink'}
+# EPSG codes of the spherical mercator used by the viewer
+WMTS_MERCATOR = ('3857', '900913', '3785', '102100', '102113')
+# standardized rendering pixel size in metres (OGC WMTS 1.0.0, 6.1)
+WMTS_PIXELSIZE = 0.00028
+# tolerance on matching matrix scales and corners, in tiles
+WMTS_TOLERANCE = 0.01
+#################################################################################
+
+def _text(element, path, default=None):
+  found = element.find(path, WMTS_NS)
+  if found is None or found.text is None:
+    return default
+  return found.text.strip()
+
+def parse_matrixset(element):
+  '''Return the zoom levels of the viewer's mercator pyramid served by a
+     TileMatrixSet element, as {zoom: (matrix identifier, column offset,
+     row offset, matrix width, matrix height)}. Empty if the set is not
+     spherical mercator.'''
+  crs = _text(element, 'ows:SupportedCRS', '')
+  if crs.replace('::', ':').split(':')[-1] not in WMTS_MERCATOR:
+    return {}
+  world = 2 * GCONST
+  zooms = {}
+  for matrix in element.findall('wmts:TileMatrix', WMTS_NS):
+    try:
+      identifier = _text(matrix, 'ows:Identifier')
+      scale = float(_text(matrix, 'wmts:ScaleDenominator'))
+      left, top = map(float, _text(matrix, 'wmts:TopLeftCorner').split()[:2])
+      tilew = int(_text(matrix, 'wmts:TileWidth', '256'))
+      width = int(_text(matrix, 'wmts:MatrixWidth'))
+      height = int(_text(matrix, 'wmts:MatrixHeight'))
+    except (TypeError, ValueError), e:
+      Logger.error('WMTSTileServer: invalid TileMatrix [%s]' % e)
+      continue
+    span = tilew * scale * WMTS_PIXELSIZE  # tile size in metres
+    zoom = log(world / span, 2)
+    if abs(zoom - round(zoom)) > WMTS_TOLERANCE:
+      continue
+    # the matrix may only cover a part of the world: offset its indices
+    col = (left + GCONST) / span
+    row = (GCONST - top) / span
+    if abs(col - round(col)) > WMTS_TOLERANCE or abs(row - round(row)) > WMTS_TOLERANCE:
+      continue
+    zooms[int(round(zoom))] = (identifier, int(round(col)), int(round(row)), width, height)
+  return zooms
+
+
+class WMTSTileServer(TileServer):
+    '''Generic WMTS tile server: pre-rendered tiles of a layer, from the
+    TileMatrixSet of the GetCapabilities document matching the viewer's
+    spherical mercator pyramid. Tiles are requested with the layer's REST
+    template if there is one, by KVP otherwise.
+
+    The map type selects the layer (available_maptype lists them); unknown
+    map types fall back to the layer chosen in initFromGetCapabilities.
+    See StatkartWMTSTileServer below for extending it to a provider.
+    '''
+    provider_name = 'wmts'
+
+    def geturl(self, nx, ny, lx, ly, tilew, tileh, zoom, format, maptype):
+      matrix = self.matrices.get(zoom)
+      if matrix is None:
+        return None
+      identifier, col0, row0, width, height = matrix
+      col, row = nx - col0, ny - row0
+      if not (0 <= col < width and 0 <= row < height):
+        return None
+      layer = maptype if maptype in self.layers else self.layer
+      if self.template:
+        url = self.template
+        for name, value in self.dimensions.items() + [
+            ('Layer', layer), ('Style', self.style), ('TileMatrixSet', self.matrixset),
+            ('TileMatrix', identifier), ('TileRow', row), ('TileCol', col)]:
+          url = url.replace('{%s}' % name, str(value))
+        return url
+      return self.url + '&LAYER=%s&TILEMATRIX=%s&TILEROW=%d&TILECOL=%d' % (
+          layer, identifier, row, col)
+
+    def initFromGetCapabilities(self, host, baseurl, layer = None, index = 0, matrixset = None):
+      '''Fetch the capabilities from http://host/baseurl and choose a layer
+      (by name, else by alphabetical index) and a tile matrix set'''
+      separator = '?' in baseurl and '&' or '?'
+      capabilities = urlopen(host + baseurl + separator +
+          'SERVICE=WMTS&REQUEST=GetCapabilities&VERSION=1.0.0').read()
+      self.initFromCapabilities(capabilities, host + baseurl, layer, index, matrixset)
+
+    def initFromCapabilities(self, capabilities, url, layer = None, index = 0, matrixset = None):
+      '''Configure the server from a GetCapabilities document fetched from
+      `url`. Raise an exception if no layer is served in spherical mercator.'''
+      tree = ET.fromstring(capabilities)
+      contents = tree.find('wmts:Contents', WMTS_NS)
+      sets = dict((_text(element, 'ows:Identifier'), parse_matrixset(element))
+                  for element in contents.findall('wmts:TileMatrixSet', WMTS_NS))
+      layers = dict((_text(element, 'ows:Identifier'), element)
+                    for element in contents.findall('wmts:Layer', WMTS_NS))
+      if not layers:
+        raise Exception('WMTS %s serves no layer' % url)
+      self.layers = layers.keys()
+      self.available_maptype = dict((name, _text(element, 'ows:Title', name))
+                                    for name, element in layers.items())
+      if layer not in layers:
+        if layer is not None:
+          Logger.error('WMTSTileServer: no layer %s at %s' % (layer, url))
+        layer = sorted(layers.keys())[index]
+      element = layers[layer]
+
+      # tile matrix set: the requested one, else the one linked to the layer
+      # covering the most zoom levels
+      linked = [_text(link, 'wmts:TileMatrixSet')
+                for link in element.findall('wmts:TileMatrixSetLink', WMTS_NS)]
+      if matrixset is None:
+        candidates = [name for name in linked if sets.get(name)]
+        if not candidates:
+          raise Exception('WMTS layer %s is not served in spherical mercator (%s)' % (
+              layer, ', '.join(linked)))
+        matrixset = max(candidates, key=lambda name: len(sets[name]))
+      self.layer = layer
+      self.matrixset = matrixset
+      self.matrices = sets.get(matrixset, {})
+
+      # format and style
+      formats = [f.text.strip() for f in element.findall('wmts:Format', WMTS_NS)]
+      self.format = 'image/png' in formats and 'image/png' or (formats and formats[0] or 'image/png')
+      styles = element.findall('wmts:Style', WMTS_NS)
+      styles = [s for s in styles if s.get('isDefault') == 'true'] or styles
+      self.style = styles and _text(styles[0], 'ows:Identifier', 'default') or 'default'
+      self.dimensions = dict((_text(d, 'ows:Identifier'), _text(d, 'wmts:Default', ''))
+                             for d in element.findall('wmts:Dimension', WMTS_NS))
+
+      # REST template, else KVP requests on the GetTile endpoint
+      self.template = None
+      for resource in element.findall('wmts:ResourceURL', WMTS_NS):
+        if resource.get('resourceType') == 'tile' and \
+           (self.template is None or resource.get('format') == self.format):
+          self.template = resource.get('template')
+      endpoint = url.split('?')[0]
+      for operation in tree.findall('ows:OperationsMetadata/ows:Operation', WMTS_NS):
+        if operation.get('name') == 'GetTile':
+          get = operation.find('ows:DCP/ows:HTTP/ows:Get', WMTS_NS)
+          if get is not None:
+            endpoint = get.get('{%s}href' % WMTS_NS['xlink'], endpoint)
+      endpoint = endpoint.rstrip('?&')
+      separator = '?' in endpoint and '&' or '?'
+      self.url = endpoint + separator + \
+          'SERVICE=WMTS&REQUEST=GetTile&VERSION=1.0.0&STYLE=%s&FORMAT=%s&TILEMATRIXSET=%s' % (
+          self.style, self.format, self.matrixset)
+
+      # the workers fetch paths from provider_host
+      parts = urlsplit(self.template or self.url)
+      self.provider_host = parts.netloc
+      prefix = '%s://%s' % (parts.scheme, parts.netloc)
+      if self.template:
+        self.template = self.template[len(prefix):]
+      else:
+        self.url = self.url[len(prefix):]
+      print "Displaying from %s: layer %s in tile matrix set %s, zoom %s-%s." % (
+          url, layer, matrixset, min(self.matrices or [0]), max(self.matrices or [0]))
+
+
+class StatkartWMTSTileServer(WMTSTileServer):
+    '''Kartverket topographic map, from the open WMTS cache'''
+    provider_name = 'statkartwmts'
+    provider_host = 'opencache.statkart.no'
+    available_maptype = dict(topo2 = 'Topographic')
+
+    def __init__(self, **kwargs):
+      super(StatkartWMTSTileServer, self).__init__(**kwargs)
+      self.initFromGetCapabilities('http://opencache.statkart.no', '/gatekeeper/gk/gk.open_wmts', layer='topo2')
+
+TileServer.register(StatkartWMTSTileServer)
@@ -0,0 +1,140 @@
+'''
+Cache janitor: keeps a TileStore under a byte budget by evicting the least
+recently used tiles from a background thread
+'''
+
+__all__ = ('CacheJanitor', )
+
+from threading import Thread, Lock
+from time import time, sleep
+from kivy.logger import Logger
+
+### static configuration - TODO: parametrize ####################################
+# seconds between two janitor passes
+JANITOR_INTERVAL = 30
+# number of tiles deleted at once
+JANITOR_BATCHSIZE = 200
+# pause between two batches, to leave the disk to the download workers
+JANITOR_PAUSE = .5
+# once over budget, evict down to this fraction of the budget
+JANITOR_LOWWATER = .9
+#################################################################################
+
+class CacheJanitor(object):
+    '''Track the size and last access time of every tile of a store, and evict
+    the least recently used ones once the store outgrows `budget` bytes.
+
+    Access times are only recorded in memory when tiles are used (see touch),
+    and written back to the store by the janitor thread in batches, and on
+    stop.
+
+    :Parameters:
+        `store`: TileStore
+            Store to look after
+        `budget`: int
+            Maximum size of the store in bytes
+        `interval`: int, default to 30
+            Seconds between two passes
+    '''
+
+    def __init__(self, store, budget, interval=JANITOR_INTERVAL):
+        self.store      = store
+        self.budget     = budget
+        self.interval   = interval
+        self.index      = dict()  # key -> [size, last access]
+        self.size       = 0
+        self.touched    = dict()
+        self.lock       = Lock()
+        self.thread     = None
+        self.want_close = False
+        self.stats      = dict(evicted=0, evicted_bytes=0)
+
+    def start(self):
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''Stop the janitor thread, and write the access times not yet
+        persisted'''
+        self.want_close = True
+        try:
+            self._persist()
+        except:
+            Logger.exception('CacheJanitor: cannot persist the access times')
+
+    def touch(self, key):
+        '''Record an access to a tile. Called from the workers and for every
+        tile served from memory: only a dict assignment, no syscall.'''
+        self.touched[key] = time()
+
+    def added(self, key, size):
+        '''Record a tile written to the store'''
+        now = time()
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is not None:
+                self.size -= entry[0]
+            self.index[key] = [size, now]
+            self.size += size
+
+    def _run(self):
+        try:
+            self._scan()
+            while not self.want_close:
+                sleep(self.interval)
+                self._persist()
+                if self.size > self.budget:
+                    self._evict()
+        except:
+            Logger.exception('CacheJanitor: Unknown exception, stop the janitor')
+
+    def _scan(self):
+        count = 0
+        for key, size, accessed in self.store.scan():
+            if self.want_close:
+                return
+            with self.lock:
+                if key not in self.index:
+                    self.index[key] = [size, accessed]
+                    self.size += size
+            count += 1
+            if count % 1000 == 0:
+                sleep(0) # let the workers run
+        Logger.info('CacheJanitor: %s holds %d tiles, %d of %d bytes' % (
+            self.store.path, len(self.index), self.size, self.budget))
+
+    def _persist(self):
+        '''Write the access times collected since the last pass to the store'''
+        touched, self.touched = self.touched, dict()
+        if not touched:
+            return
+        with self.lock:
+            for key, t in touched.iteritems():
+                entry = self.index.get(key)
+                if entry is not None:
+                    entry[1] = t
+        self.store.touch(touched)
+
+    def _evict(self):
+        target = self.budget * JANITOR_LOWWATER
+        with self.lock:
+            lru = sorted(self.index.iteritems(), key=lambda item: item[1][1])
+        for i in xrange(0, len(lru), JANITOR_BATCHSIZE):
+            if self.want_close or self.size <= target:
+                break
+            batch = []
+            with self.lock:
+                for key, entry in lru[i:i + JANITOR_BATCHSIZE]:
+                    if self.size <= target:
+                        break
+                    # skip tiles read or rewritten since the snapshot
+                    if key in self.touched or self.index.get(key) is not entry:
+                        continue
+                    del self.index[key]
+                    self.size -= entry[0]
+                    self.stats['evicted'] += 1
+                    self.stats['evicted_bytes'] += entry[0]
+                    batch.append(key)
+            self.store.delete(batch)
+            sleep(JANITOR_PAUSE)
@@ -0,0 +1,120 @@
+'''
+Connection pool: persistent HTTP/1.1 connections shared by worker threads
+'''
+
+__all__ = ('HTTPConnectionPool', )
+
+from httplib import HTTPConnection, HTTPException
+from urlparse import urlsplit
+from threading import Lock
+import socket
+
+### static configuration - TODO: parametrize ####################################
+# idle connections kept open per host
+POOL_MAXSIZE = 10
+# socket timeout in seconds
+POOL_TIMEOUT = 20
+# number of redirects followed before giving up
+POOL_MAXREDIRECT = 3
+#################################################################################
+
+class HTTPConnectionPool(object):
+    '''Per-host pool of keep-alive HTTP connections. Connections are handed
+    out to one thread at a time and put back once the response has been read,
+    so a worker downloading tile after tile from the same host pays the TCP
+    handshake only once.
+
+    :Parameters:
+        `maxsize`: int, default to 10
+            Maximum number of idle connections kept open per host
+        `timeout`: int, default to 20
+            Socket timeout in seconds
+    '''
+
+    def __init__(self, maxsize=POOL_MAXSIZE, timeout=POOL_TIMEOUT):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle    = dict()
+        self.lock    = Lock()
+        self.stats   = dict(requests=0, created=0, reused=0, stale=0)
+
+    @property
+    def reuse_ratio(self):
+        '''Fraction of requests that were sent over an already open connection'''
+        requests = self.stats['requests']
+        if not requests:
+            return 0.
+        return self.stats['reused'] / float(requests)
+
+    def fetch(self, host, url):
+        '''Download `url` (path + query) from `host` and return the body.
+        Raise IOError if the server does not answer with 200 OK.
+        '''
+        for i in xrange(POOL_MAXREDIRECT + 1):
+            status, location, data = self._request(host, url)
+            if status in (301, 302, 303, 307) and location:
+                parts = urlsplit(location)
+                host = parts.netloc or host
+                url = parts.path + (parts.query and '?' + parts.query or '')
+                continue
+            if status != 200:
+                raise IOError('HTTP %d for http://%s%s' % (status, host, url))
+            return data
+        raise IOError('Too many redirects for http://%s%s' % (host, url))
+
+    def close(self):
+        '''Close all idle connections'''
+        with self.lock:
+            idle, self.idle = self.idle, dict()
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+    def _acquire(self, host):
+        with self.lock:
+            self.stats['requests'] += 1
+            conns = self.idle.get(host)
+            if conns:
+                self.stats['reused'] += 1
+                return conns.pop(), True
+            self.stats['created'] += 1
+        return HTTPConnection(host, timeout=self.timeout), False
+
+    def _release(self, host, conn):
+        with self.lock:
+            conns = self.idle.setdefault(host, [])
+            if len(conns) < self.maxsize:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def _send(self, conn, url):
+        conn.request('GET', url, headers={'Connection': 'keep-alive'})
+        response = conn.getresponse()
+        data = response.read()
+        return response, data
+
+    def _request(self, host, url):
+        conn, reused = self._acquire(host)
+        try:
+            response, data = self._send(conn, url)
+        except (HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            # the server dropped the idle connection, retry once on a new one
+            with self.lock:
+                self.stats['stale'] += 1
+                self.stats['created'] += 1
+            conn = HTTPConnection(host, timeout=self.timeout)
+            try:
+                response, data = self._send(conn, url)
+            except:
+                conn.close()
+                raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(host, conn)
+        return response.status, response.getheader('location'), data
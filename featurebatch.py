@@ -0,0 +1,189 @@
+'''
+Feature batch: draw the features of a vector overlay in retained batches,
+points as textured Point instructions and rings as a few Meshes, instead of
+instructions per feature
+'''
+
+__all__ = ('FeatureBatch', )
+
+from math import sqrt
+from kivy.graphics import Color, Mesh, Point, InstructionGroup
+from kivy.graphics.texture import Texture
+from simplify import lod
+
+try:
+    from kivy.graphics.tesselator import Tesselator, WINDING_ODD, TYPE_POLYGONS
+except ImportError:
+    Tesselator = None  # kivy < 1.9: rings are drawn without their fill
+
+### static configuration - TODO: parametrize ####################################
+# points per Point instruction
+FEATURE_POINT_CHUNK = 2048
+# vertices per Mesh (indices are 16 bits)
+FEATURE_MESH_VERTICES = 16384
+# radius of a point marker in pixels, whatever the scale
+FEATURE_MARKER_RADIUS = 5
+# colours of the outline and of the fill of the rings
+FEATURE_RING_COLOR = (1, .5, .5, 1)
+FEATURE_FILL_COLOR = (1, .5, .5, .3)
+#################################################################################
+
+_marker = None
+
+def marker_texture(size=32):
+    '''Return the texture of the point markers (created once, from the main
+    thread)'''
+    global _marker
+    if _marker is None:
+        pixels = []
+        c = (size - 1) / 2.
+        for y in xrange(size):
+            for x in xrange(size):
+                d = sqrt((x - c) ** 2 + (y - c) ** 2) / (size / 2.)
+                if d > 1:
+                    pixels.append('\x00\x00\x00\x00')
+                elif d > .8:
+                    pixels.append('\x00\x00\x00\xff')
+                else:
+                    pixels.append('\xff\xff\xff\xff')
+        _marker = Texture.create(size=(size, size), colorfmt='rgba')
+        _marker.blit_buffer(''.join(pixels), colorfmt='rgba', bufferfmt='ubyte')
+    return _marker
+
+class FeatureBatch(object):
+    '''Retained instructions drawing a list of features.
+
+    build() converts the unit square coordinates of the features into plane
+    coordinates once, with the rings simplified for the zoom level, and is
+    only needed when the features or the zoom level change. Call set_scale()
+    on every frame to keep the markers the same size on screen.
+    `group` is the InstructionGroup to add to a canvas.
+
+    :Parameters:
+        `tile_w`, `tile_h`: int
+            Size of the plane unit, see MapViewer
+    '''
+
+    def __init__(self, tile_w, tile_h):
+        self.tile_w   = tile_w
+        self.tile_h   = tile_h
+        self.group    = InstructionGroup()
+        self.points   = []
+        self.features = None
+        self.zoom     = None
+        self.scale    = None
+        self.drawcalls = 0
+        self.vertices = 0
+
+    def to_plane(self, unit):
+        tw, th = self.tile_w, self.tile_h
+        plane = [0.] * len(unit)
+        plane[0::2] = [(u + 1) * tw for u in unit[0::2]]
+        plane[1::2] = [(v + 1) * th for v in unit[1::2]]
+        return plane
+
+    def build(self, features, zoom):
+        '''Rebuild the instructions for `features`, a list of Features with
+        unit square coordinates in `unit`, at `zoom`'''
+        self.features = features
+        self.zoom = zoom
+        self.group.clear()
+        self.drawcalls = 0
+        points, rings = [], []
+        for feature in features:
+            if not feature.unit:
+                continue
+            if feature.kind == 'Point':
+                points.extend(self.to_plane(feature.unit[:2]))
+            elif feature.kind == 'LinearRing':
+                unit = lod(feature, zoom)
+                if len(unit) >= 6:
+                    rings.append(self.to_plane(unit))
+        self.vertices = (len(points) + sum(len(ring) for ring in rings)) / 2
+        if rings and Tesselator is not None:
+            self.group.add(Color(*FEATURE_FILL_COLOR))
+            self.build_fills(rings)
+        if rings:
+            self.group.add(Color(*FEATURE_RING_COLOR))
+            self.build_outlines(rings)
+        self.points = []
+        if points:
+            self.group.add(Color(1, 1, 1, 1))
+            texture = marker_texture()
+            step = FEATURE_POINT_CHUNK * 2
+            for i in xrange(0, len(points), step):
+                point = Point(points=points[i:i + step], texture=texture,
+                              pointsize=FEATURE_MARKER_RADIUS)
+                self.group.add(point)
+                self.points.append(point)
+                self.drawcalls += 1
+        self.scale = None
+
+    def build_outlines(self, rings):
+        '''Merge the rings into a few line meshes. A ring longer than a mesh
+        continues in the next one, from the last vertex drawn.'''
+        vertices, indices = [], []
+        for ring in rings:
+            n = len(ring) / 2
+            start = 0
+            while start < n:
+                # vertices start..end of the ring, the vertex n closing it
+                end = min(start + FEATURE_MESH_VERTICES - 1, n)
+                if len(vertices) / 4 + end - start + 1 > FEATURE_MESH_VERTICES:
+                    self.add_mesh(vertices, indices, 'lines')
+                    vertices, indices = [], []
+                j = len(vertices) / 4
+                for i in xrange(start, end + 1):
+                    k = i % n
+                    vertices.extend((ring[2 * k], ring[2 * k + 1], 0, 0))
+                for i in xrange(end - start):
+                    indices.extend((j + i, j + i + 1))
+                start = end
+        self.add_mesh(vertices, indices, 'lines')
+
+    def build_fills(self, rings):
+        '''Tessellate the rings into triangles, merged into a few meshes. A
+        polygon larger than a mesh is split into fans sharing its first
+        vertex.'''
+        vertices, indices = [], []
+        for ring in rings:
+            tess = Tesselator()
+            tess.add_contour(ring)
+            if not tess.tesselate(WINDING_ODD, TYPE_POLYGONS):
+                continue
+            for polygon, fan in tess.meshes:
+                n = len(polygon) / 4
+                start = 1
+                while start < n - 1:
+                    # the fan of vertex 0 over vertices start..end
+                    end = min(start + FEATURE_MESH_VERTICES - 2, n - 1)
+                    if len(vertices) / 4 + end - start + 2 > FEATURE_MESH_VERTICES:
+                        self.add_mesh(vertices, indices, 'triangles')
+                        vertices, indices = [], []
+                    j = len(vertices) / 4
+                    vertices.extend(polygon[:4])
+                    vertices.extend(polygon[4 * start:4 * (end + 1)])
+                    for k in xrange(end - start):
+                        indices.extend((j, j + k + 1, j + k + 2))
+                    start = end
+        self.add_mesh(vertices, indices, 'triangles')
+
+    def add_mesh(self, vertices, indices, mode):
+        if indices:
+            self.group.add(Mesh(vertices=vertices, indices=indices, mode=mode))
+            self.drawcalls += 1
+
+    def set_scale(self, scale):
+        '''Size the markers for the scale of the plane'''
+        if scale == self.scale:
+            return
+        self.scale = scale
+        for point in self.points:
+            point.pointsize = FEATURE_MARKER_RADIUS / float(scale)
+
+    def clear(self):
+        self.group.clear()
+        self.points = []
+        self.features = None
+        self.drawcalls = 0
+        self.vertices = 0
@@ -0,0 +1,156 @@
+'''
+Feature disk cache: the features loaded by the vector overlays, kept in a
+SQLite database with an R-tree index, for warm starts and offline use.
+
+Features are stored per layer, a key naming the provider, the feature type
+and the SRS, with their coordinates in that SRS, their unit square
+coordinates and their Douglas-Peucker ranks (see simplify), so that they are
+drawn again without being reprojected. The cells loaded are recorded with
+the time they were fetched: cells older than the TTL are revalidated
+against the server, and only served from disk if it cannot be reached.
+'''
+
+__all__ = ('FeatureDiskCache', )
+
+from os.path import dirname, isdir
+from os import makedirs
+from threading import Lock
+from array import array
+from time import time
+import sqlite3
+import json
+
+from gmlparser import Feature
+from featurestore import feature_key
+
+### static configuration - TODO: parametrize ####################################
+# seconds before cached cells are fetched again
+FEATURECACHE_TTL = 7 * 24 * 3600
+#################################################################################
+
+def _blob(values, typecode):
+    if values is None:
+        return None
+    return buffer(array(typecode, values).tostring())
+
+def _array(blob, typecode):
+    values = array(typecode)
+    if blob is not None:
+        values.fromstring(str(blob))
+    return values
+
+class FeatureDiskCache(object):
+    '''Features and loaded cells of vector overlays in one SQLite database.
+    The R-tree index needs SQLite built with the RTREE module, else a plain
+    table is used and queries scan it.
+
+    :Parameters:
+        `path`: str
+            Database file
+        `ttl`: int, default to FEATURECACHE_TTL
+            Seconds before a cached cell needs to be revalidated
+    '''
+
+    def __init__(self, path, ttl=FEATURECACHE_TTL):
+        if dirname(path) and not isdir(dirname(path)):
+            makedirs(dirname(path))
+        self.path = path
+        self.ttl  = ttl
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS features (
+                id INTEGER PRIMARY KEY, layer TEXT, fkey TEXT, kind TEXT,
+                coords BLOB, unit BLOB, ranks BLOB, attributes TEXT);
+            CREATE UNIQUE INDEX IF NOT EXISTS features_index ON features (layer, fkey);
+            CREATE TABLE IF NOT EXISTS cells (
+                layer TEXT, x INTEGER, y INTEGER, zoom INTEGER,
+                truncated INTEGER, fetched REAL,
+                PRIMARY KEY (layer, x, y, zoom));
+        ''')
+        try:
+            self.db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS features_rtree '
+                            'USING rtree(id, xmin, xmax, ymin, ymax)')
+        except sqlite3.OperationalError:
+            self.db.execute('CREATE TABLE IF NOT EXISTS features_rtree ('
+                            'id INTEGER PRIMARY KEY, xmin REAL, xmax REAL, ymin REAL, ymax REAL)')
+        self.db.commit()
+
+    def read_cell(self, layer, cell, area, limit=-1):
+        '''Return (features, truncated, fresh) for a cell loaded before, or
+        None. `area` (xmin, ymin, xmax, ymax) is the cell in the SRS of the
+        layer: the features are the stored features intersecting it, at most
+        `limit` if the cell was truncated.'''
+        with self.lock:
+            row = self.db.execute('SELECT truncated, fetched FROM cells WHERE layer=? '
+                'AND x=? AND y=? AND zoom=?', (layer, ) + tuple(cell)).fetchone()
+            if row is None:
+                return None
+            truncated, fetched = row
+            rows = self.db.execute('SELECT f.fkey, f.kind, f.coords, f.unit, f.ranks, '
+                'f.attributes FROM features_rtree r JOIN features f ON f.id = r.id '
+                'WHERE r.xmax >= ? AND r.xmin <= ? AND r.ymax >= ? AND r.ymin <= ? '
+                'AND f.layer = ? LIMIT ?', (area[0], area[2], area[1], area[3], layer,
+                truncated and limit or -1)).fetchall()
+        features = []
+        for fkey, kind, coords, unit, ranks, attributes in rows:
+            feature = Feature(fkey if not fkey.startswith('#') else None, kind,
+                              _array(coords, 'd').tolist(),
+                              [tuple(pair) for pair in json.loads(attributes)])
+            feature.unit = _array(unit, 'f')
+            if ranks is not None:
+                feature.ranks = _array(ranks, 'f')
+            features.append(feature)
+        return features, bool(truncated), time() < fetched + self.ttl
+
+    def write_cell(self, layer, cell, features, truncated, area=None):
+        '''Store the features fetched for a cell, replacing their previous
+        versions. If the response was complete, the features stored within
+        `area` (the cell in the SRS of the layer) are deleted first: those
+        missing from the response are gone from the server.'''
+        with self.lock:
+            db = self.db
+            if area is not None and not truncated:
+                old = db.execute('SELECT r.id FROM features_rtree r JOIN features f '
+                    'ON f.id = r.id WHERE r.xmin >= ? AND r.xmax <= ? AND r.ymin >= ? '
+                    'AND r.ymax <= ? AND f.layer = ?', (area[0], area[2], area[1], area[3],
+                    layer)).fetchall()
+                db.executemany('DELETE FROM features WHERE id=?', old)
+                db.executemany('DELETE FROM features_rtree WHERE id=?', old)
+            for feature in features:
+                key = feature_key(feature)
+                fkey = key if feature.id is not None else '#%s' % key
+                old = db.execute('SELECT id FROM features WHERE layer=? AND fkey=?',
+                                 (layer, fkey)).fetchone()
+                if old is not None:
+                    db.execute('DELETE FROM features WHERE id=?', old)
+                    db.execute('DELETE FROM features_rtree WHERE id=?', old)
+                if feature.kind is None or not feature.coords:
+                    continue
+                cur = db.execute('INSERT INTO features (layer, fkey, kind, coords, unit, '
+                    'ranks, attributes) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (layer, fkey, feature.kind, _blob(feature.coords, 'd'),
+                     _blob(feature.unit, 'f'), _blob(feature.ranks, 'f'),
+                     json.dumps(feature.attributes)))
+                xs, ys = feature.coords[0::2], feature.coords[1::2]
+                db.execute('INSERT INTO features_rtree (id, xmin, xmax, ymin, ymax) '
+                    'VALUES (?, ?, ?, ?, ?)', (cur.lastrowid, min(xs), max(xs), min(ys), max(ys)))
+            db.execute('INSERT OR REPLACE INTO cells (layer, x, y, zoom, truncated, fetched) '
+                'VALUES (?, ?, ?, ?, ?, ?)', (layer, ) + tuple(cell) + (int(truncated), time()))
+            db.commit()
+
+    def clear(self, layer):
+        '''Forget every feature and cell of a layer'''
+        with self.lock:
+            self.db.execute('DELETE FROM features_rtree WHERE id IN '
+                            '(SELECT id FROM features WHERE layer=?)', (layer, ))
+            self.db.execute('DELETE FROM features WHERE layer=?', (layer, ))
+            self.db.execute('DELETE FROM cells WHERE layer=?', (layer, ))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
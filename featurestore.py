@@ -0,0 +1,220 @@
+'''
+Feature store: the features of a vector overlay in a few contiguous arrays.
+
+Every feature is a row: its vertices are a slice of the coordinate arrays
+given by an offset index, and its attributes a slice of (name, value) pairs
+of indices into a table of interned strings. StoredFeature is a light view
+of a row, with the attributes of the parsed Features (see gmlparser).
+
+Run this module to compare the memory used by 100000 parsed Features and by
+a store holding the same features.
+'''
+
+__all__ = ('FeatureStore', 'StoredFeature', 'KINDS', 'feature_key')
+
+from array import array
+
+### static configuration - TODO: parametrize ####################################
+# geometry kinds, as recognized by gmlparser (None: no geometry)
+KINDS = (None, 'Point', 'LinearRing')
+#################################################################################
+
+_KIND_CODES = dict((kind, code) for code, kind in enumerate(KINDS))
+
+def feature_key(feature):
+    '''Return the identity of a feature: its id, else a hash of its
+    geometry'''
+    if feature.id is not None:
+        return feature.id
+    return hash((feature.kind, array('d', feature.coords).tostring()))
+
+class _Lods(dict):
+    '''Levels of detail of a row, {zoom: coordinates}, counted in the size
+    of the store'''
+    __slots__ = ('store', )
+
+    def __init__(self, store):
+        dict.__init__(self)
+        self.store = store
+
+    def __setitem__(self, zoom, coords):
+        old = self.get(zoom)
+        if old is not None:
+            self.store.lod_nbytes -= old.itemsize * len(old)
+        self.store.lod_nbytes += coords.itemsize * len(coords)
+        dict.__setitem__(self, zoom, coords)
+
+class StoredFeature(object):
+    '''View of a row of a FeatureStore, valid until the store is compacted'''
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row   = row
+
+    @property
+    def id(self):
+        sid = self.store.ids[self.row]
+        return self.store.strings[sid] if sid >= 0 else None
+
+    @property
+    def kind(self):
+        return KINDS[self.store.kinds[self.row]]
+
+    @property
+    def coords(self):
+        offsets = self.store.offsets
+        return self.store.coords[2 * offsets[self.row]:2 * offsets[self.row + 1]]
+
+    @property
+    def unit(self):
+        offsets = self.store.offsets
+        return self.store.unit[2 * offsets[self.row]:2 * offsets[self.row + 1]]
+
+    @property
+    def ranks(self):
+        if self.kind != 'LinearRing':
+            return None
+        offsets = self.store.offsets
+        return self.store.ranks[offsets[self.row]:offsets[self.row + 1]]
+
+    @property
+    def lods(self):
+        lods = self.store.lods.get(self.row)
+        if lods is None:
+            lods = self.store.lods[self.row] = _Lods(self.store)
+        return lods
+
+    @property
+    def attributes(self):
+        store = self.store
+        a, b = store.attr_offsets[self.row], store.attr_offsets[self.row + 1]
+        pairs = store.attrs[2 * a:2 * b]
+        return [(store.strings[pairs[i]], store.strings[pairs[i + 1]])
+                for i in xrange(0, len(pairs), 2)]
+
+    def bbox(self):
+        coords = self.coords
+        xs, ys = coords[0::2], coords[1::2]
+        return min(xs), min(ys), max(xs), max(ys)
+
+class FeatureStore(object):
+    '''Columnar storage of features. Rows are only appended: to release
+    some, copy() the others into a new store.'''
+
+    def __init__(self):
+        self.strings      = []          # string table
+        self.string_ids   = dict()      # string -> index in the table
+        self.kinds        = array('b')  # row -> index in KINDS
+        self.ids          = array('l')  # row -> string of the feature id, or -1
+        self.offsets      = array('l', [0])  # row -> first vertex, and end of the last row
+        self.coords       = array('d')  # x, y per vertex, in the SRS of the overlay
+        self.unit         = array('f')  # x, y per vertex, in the unit square
+        self.ranks        = array('f')  # Douglas-Peucker rank per vertex (rings)
+        self.attr_offsets = array('l', [0])  # row -> first attribute
+        self.attrs        = array('l')  # name, value string indices per attribute
+        self.lods         = dict()      # row -> {zoom: simplified unit coordinates}
+        self.string_nbytes = 0          # approximate size of the strings
+        self.lod_nbytes   = 0           # size of the levels of detail
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def intern(self, string):
+        '''Return the index of a string in the table, adding it if needed'''
+        sid = self.string_ids.get(string)
+        if sid is None:
+            sid = self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+            self.string_nbytes += len(string) + 140
+        return sid
+
+    def add(self, feature):
+        '''Append a parsed Feature, with its `unit` coordinates and their
+        `ranks` if any, and return its row'''
+        row = len(self.kinds)
+        self.kinds.append(_KIND_CODES.get(feature.kind, 0))
+        self.ids.append(self.intern(feature.id) if feature.id is not None else -1)
+        vertices = len(feature.coords) / 2
+        self.coords.extend(feature.coords[:2 * vertices])
+        unit = feature.unit
+        if unit is None or len(unit) != 2 * vertices:
+            unit = array('f', [0.]) * (2 * vertices)
+        self.unit.extend(unit)
+        ranks = feature.ranks
+        if ranks is None or len(ranks) != vertices:
+            ranks = array('f', [float('inf')]) * vertices
+        self.ranks.extend(array('f', ranks))
+        self.offsets.append(self.offsets[-1] + vertices)
+        for name, value in feature.attributes:
+            self.attrs.append(self.intern(name))
+            self.attrs.append(self.intern(value))
+        self.attr_offsets.append(len(self.attrs) / 2)
+        return row
+
+    def copy(self, source, row):
+        '''Append a row of another store and return its row here'''
+        return self.add(StoredFeature(source, row))
+
+    def feature(self, row):
+        return StoredFeature(self, row)
+
+    @property
+    def nbytes(self):
+        '''Approximate memory used by the store, kept up to date as rows,
+        strings and levels of detail are added'''
+        size = sum(a.itemsize * len(a) for a in (
+            self.kinds, self.ids, self.offsets, self.coords, self.unit,
+            self.ranks, self.attr_offsets, self.attrs))
+        return size + self.string_nbytes + self.lod_nbytes
+
+
+if __name__ == '__main__':
+    import sys, resource
+    from subprocess import Popen, PIPE
+    from gmlparser import Feature
+    from simplify import ranks
+
+    def generate(count):
+        '''parsed features, as kept by the overlay before: a point of
+        interest and a 20 vertices ring out of every 2'''
+        for i in xrange(count):
+            x, y = 10 + (i % 1000) * .001, 59 + (i / 1000) * .001
+            if i % 2:
+                coords = [x, y]
+                kind = 'Point'
+            else:
+                coords = []
+                for j in xrange(19):
+                    coords.extend((x + j * .0001, y + (j % 2) * .0001))
+                coords.extend(coords[:2])
+                kind = 'LinearRing'
+            feature = Feature('feature.%d' % i, kind, coords,
+                              [('name', 'Feature %d' % i), ('kind', kind.lower())])
+            feature.unit = array('f', [c / 180. for c in coords])
+            if kind == 'LinearRing':
+                feature.ranks = ranks(feature.unit)
+            yield feature
+
+    def run(mode, count):
+        '''keep `count` features, print the peak memory in kB over the baseline'''
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if mode == 'features':
+            kept = list(generate(count))
+        else:
+            kept = FeatureStore()
+            for feature in generate(count):
+                kept.add(feature)
+        print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+
+    if len(sys.argv) > 2 and sys.argv[1] == '--run':
+        run(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+    print '%-10s %12s %14s' % ('storage', 'memory (MB)', 'per feature (B)')
+    for mode in ('features', 'store'):
+        # a fresh interpreter for each storage, so that peak memory is its own
+        out = Popen([sys.executable, __file__, '--run', mode, str(count)], stdout=PIPE).communicate()[0]
+        kb = int(out)
+        print '%-10s %12.1f %14d' % (mode, kb / 1024., kb * 1024 / count)
@@ -0,0 +1,188 @@
+'''
+GML parser: stream the features of a WFS GetFeature response.
+
+Features are yielded while the response is read, and their elements are
+freed as soon as the geometry and the attributes are pulled out, so that
+neither the document nor its tree are ever held in memory.
+
+Run this module to compare it with loading and parsing the whole document
+on a generated 50 MB GML file (peak memory, time to the first feature and
+total time)::
+
+    python gmlparser.py [megabytes]
+'''
+
+__all__ = ('GMLNS', 'Feature', 'iterfeatures', 'ProgressReader')
+
+try:
+    from xml.etree import cElementTree as ET
+except ImportError:
+    from xml.etree import ElementTree as ET
+
+GMLNS = "http://www.opengis.net/gml"
+
+### static configuration - TODO: parametrize ####################################
+# bytes read from the response at a time
+GML_CHUNKSIZE = 64 * 1024
+#################################################################################
+
+GEOMETRIES = dict(('{%s}%s' % (GMLNS, kind), kind) for kind in ('Point', 'LinearRing'))
+COORDINATES = set('{%s}%s' % (GMLNS, tag) for tag in ('coordinates', 'pos', 'posList'))
+MEMBER = '{%s}featureMember' % GMLNS
+MEMBERS = '{%s}featureMembers' % GMLNS
+GMLID = '{%s}id' % GMLNS
+
+class Feature(object):
+    '''A WFS feature: the `kind` of its geometry ('Point', 'LinearRing' or
+    None), its flat `coords` (x, y, x, y, ... in the SRS of the request),
+    its `attributes` [(name, text), ...] and its `id` (gml:id or fid, or
+    None). `unit`, `ranks` and `lods` are left to the overlay, for the
+    coordinates projected to the unit square and their levels of detail
+    (see simplify).
+    '''
+    __slots__ = ('id', 'kind', 'coords', 'attributes', 'unit', 'ranks', 'lods')
+
+    def __init__(self, id, kind, coords, attributes):
+        self.id         = id
+        self.kind       = kind
+        self.coords     = coords
+        self.attributes = attributes
+        self.unit       = None
+        self.ranks      = None
+        self.lods       = None
+
+class ProgressReader(object):
+    '''File-like wrapper reporting the number of bytes read'''
+
+    def __init__(self, fd, callback=None):
+        self.fd       = fd
+        self.callback = callback
+        self.loaded   = 0
+
+    def read(self, size=GML_CHUNKSIZE):
+        data = self.fd.read(size)
+        self.loaded += len(data)
+        if self.callback:
+            self.callback(self.loaded)
+        return data
+
+def _localname(tag):
+    return tag[tag.find('}') + 1:]
+
+def parse_feature(elem):
+    '''Return the Feature of a feature element. Its kind is None if it has
+    no supported geometry.'''
+    kind, coords = None, []
+    for child in elem.iter():
+        kind = GEOMETRIES.get(child.tag)
+        if kind is not None:
+            for node in child.iter():
+                if node.tag in COORDINATES and node.text:
+                    coords.extend(map(float, node.text.replace(',', ' ').split()))
+            break
+    attributes = [(_localname(field.tag), field.text) for field in elem
+                  if field.text is not None and field.text.strip() != '']
+    return Feature(elem.get(GMLID) or elem.get('fid'), kind, coords, attributes)
+
+def iterfeatures(source, chunksize=GML_CHUNKSIZE):
+    '''Yield the Features of a GML document read from the file-like `source`,
+    as they are parsed. Both featureMember and featureMembers are supported.
+    '''
+    stack = []
+    for event, elem in ET.iterparse(_Chunked(source, chunksize), events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        if not stack:
+            break
+        parent = stack[-1]
+        if elem.tag == MEMBER:
+            feature = parse_feature(elem[0]) if len(elem) else None
+        elif parent.tag == MEMBERS:
+            feature = parse_feature(elem)
+        else:
+            continue
+        # done with this element: free it
+        elem.clear()
+        parent.remove(elem)
+        if feature is not None:
+            yield feature
+
+class _Chunked(object):
+    '''Let iterparse read `chunksize` bytes at a time'''
+
+    def __init__(self, source, chunksize):
+        self.source    = source
+        self.chunksize = chunksize
+
+    def read(self, size=-1):
+        return self.source.read(self.chunksize)
+
+
+if __name__ == '__main__':
+    import sys, os, resource, tempfile
+    from time import time
+    from subprocess import Popen, PIPE
+
+    def generate(filename, megabytes):
+        member = ('<gml:featureMember><app:poi gml:id="poi.%d"><app:name>Point of interest %d</app:name>'
+                  '<app:kind>viewpoint</app:kind><app:geom><gml:Point srsName="EPSG:4326">'
+                  '<gml:pos>%f %f</gml:pos></gml:Point></app:geom></app:poi></gml:featureMember>\n')
+        ring = ('<gml:featureMember><app:area gml:id="area.%d"><app:name>Area %d</app:name><app:geom>'
+                '<gml:Polygon><gml:exterior><gml:LinearRing><gml:posList>%s</gml:posList>'
+                '</gml:LinearRing></gml:exterior></gml:Polygon></app:geom></app:area></gml:featureMember>\n')
+        with open(filename, 'w') as fd:
+            fd.write('<?xml version="1.0"?>\n<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs" '
+                     'xmlns:gml="%s" xmlns:app="http://example.com/app">\n' % GMLNS)
+            i = 0
+            while fd.tell() < megabytes * 1024 * 1024:
+                x, y = 10 + (i % 1000) * .001, 59 + (i / 1000) * .001
+                fd.write(member % (i, i, y, x))
+                fd.write(ring % (i, i, ' '.join('%f %f' % (y + j * .0001, x) for j in xrange(20))))
+                i += 1
+            fd.write('</wfs:FeatureCollection>\n')
+
+    def run(filename, mode):
+        '''parse in this process, print: features, first feature s, total s, peak kB'''
+        start = time()
+        first = None
+        count = 0
+        with open(filename) as fd:
+            if mode == 'stream':
+                for feature in iterfeatures(fd):
+                    if first is None:
+                        first = time() - start
+                    count += 1
+            else:
+                # the previous implementation: read everything, then parse a tree
+                blocks = []
+                while True:
+                    block = fd.read(4096)
+                    if not block:
+                        break
+                    blocks.append(block)
+                tree = ET.fromstring(''.join(blocks))
+                for member in tree.findall(MEMBER):
+                    feature = parse_feature(member[0])
+                    if first is None:
+                        first = time() - start
+                    count += 1
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print count, first, time() - start, peak
+
+    if len(sys.argv) > 2 and sys.argv[1] == '--run':
+        run(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    megabytes = len(sys.argv) > 1 and int(sys.argv[1]) or 50
+    filename = os.path.join(tempfile.gettempdir(), 'gmlparser-%dMB.gml' % megabytes)
+    if not os.path.exists(filename):
+        print 'Generating %s' % filename
+        generate(filename, megabytes)
+    print '%-10s %10s %12s %10s %12s' % ('mode', 'features', 'first (s)', 'total (s)', 'peak (MB)')
+    for mode in ('tree', 'stream'):
+        # a fresh interpreter for each mode, so that peak memory is its own
+        out = Popen([sys.executable, __file__, '--run', filename, mode], stdout=PIPE).communicate()[0]
+        count, first, total, peak = out.split()
+        print '%-10s %10s %12.3f %10.3f %12.1f' % (mode, count, float(first), float(total), int(peak) / 1024.)
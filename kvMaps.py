@@ -11,6 +11,7 @@ from kivy.uix.button import Button
 from sidepanel import SidePanel
 from MapViewer import MapViewer
 import WMSTileServer
+import WMTSTileServer
 from WMSOverlayServer import *
 
 
@@ -36,6 +37,7 @@ class KVMaps(App):
     self.add_kart(menu, "Microsoft Bing Roads", 'bing', 'Roadmap')
     self.add_kart(menu, "Microsoft Bing Satellite", 'bing', 'Satellite')
     self.add_kart(menu, "OSM-WMS", 'osmwms', 'Roadmap')
+    self.add_kart(menu, "Kartverket Topo (WMTS)", 'statkartwmts', 'topo2')
     layout.add_widget(menu)
 
     return layout
@@ -1,32 +1,52 @@
 try: 
-  from pyproj import Proj, transform
+  from pyproj import Proj
+  try:
+    from pyproj import Transformer  # pyproj >= 2.1
+  except ImportError:
+    Transformer = None
+  try:
+    from pyproj import transform    # legacy API, gone from recent pyproj
+  except ImportError:
+    transform = None
 
   ### utility methods for projection - pyproj support ########################################
   pLatlon = Proj(init='epsg:4326')
   p32633  = Proj(init='epsg:32633')
   pGoogle = Proj(init='epsg:3857')
-  
-  def project_to_unit(proj, x, y):
-    '''Projects any coordinate system to a bent mercator unit square.'''
-    lon, lat = transform(proj, pLatlon, x, y)
-    return latlon_to_unit(lat, lon)
-
-  def unit_to_project(proj, x, y):
-    '''Unprojects unit square to any coordinate system.'''
-    lat, lon = unit_to_latlon(x,y)
-    return transform(pLatlon, proj, lon, lat)
   #############################################################################################
     
 except ImportError:
-  pass
+  Proj = Transformer = transform = None
+from threading import local
+import re
 from math import pi, sin, cos, atan2, sqrt, radians, log, atan, exp, tan
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 ### utility methods for projection ############################################################
+# Every method accepts scalars, or (with numpy) sequences and arrays of
+# coordinates, converted in one go and returned as numpy arrays.
+
+def _arrays(*values):
+  '''Return the values as float arrays if any of them is a sequence'''
+  if numpy is None or type(values[0]) is float and type(values[-1]) is float:
+    return values # fast path for the (most common) scalar calls
+  for value in values:
+    if not isinstance(value, (int, long, float)):
+      return [numpy.asarray(v, dtype=float) for v in values]
+  return values
 
 def latlon_to_unit(lat, lon):
   '''Projects the given lat/lon to bent mercator image
      coordinates [-1,1] x [-1,1]. (as defined by Google)
   '''
+  if type(lat) is not float or type(lon) is not float:
+    lat, lon = _arrays(lat, lon)
+    if numpy is not None and isinstance(lat, numpy.ndarray):
+      return (lon / 180.0, numpy.log(numpy.tan(pi / 4.0 + (lat * pi / 180.0) / 2.0)) / pi)
   return (lon / 180.0, log(tan(pi / 4.0 + (lat * pi / 180.0) / 2.0)) / pi) #exact calculation
 
 
@@ -34,12 +54,18 @@ def unit_to_latlon(x, y):
   '''Unprojects the given bent mercator image coordinates [-1,1] x [-1,1] to
      the lat/lon space.
   '''
+  if type(x) is not float or type(y) is not float:
+    x, y = _arrays(x, y)
+    if numpy is not None and isinstance(y, numpy.ndarray):
+      return ((2 * numpy.arctan(numpy.exp(y * pi)) - pi / 2) * 180.0 / pi, x * 180)
   return ((2 * atan(exp(y * pi)) - pi / 2) * 180.0 / pi, x * 180)
 
 def p4326_to_unit(lon, lat):
+  lon, lat = _arrays(lon, lat)
   return lon / 180.0, lat / 90.0
   
 def unit_to_p4326(x, y):
+  x, y = _arrays(x, y)
   return x * 180.0, y * 90.0
 
 GCONST = 20037508.342789244
@@ -48,14 +74,17 @@ def latlon_to_google(lat, lon):
   return x*GCONST, y*GCONST
 
 def google_to_latlon(x, y):
+  x, y = _arrays(x, y)
   return unit_to_latlon(x / GCONST, y / GCONST)  
   
 def unit_to_custom(x, y, bounds):
+  x, y = _arrays(x, y)
   ulx, uly, orx, ory = bounds
   dx, dy = orx-ulx, ory-uly
   return ulx + (x + 1.0) / 2.0 * dx , uly + (y + 1.0) / 2.0 * dy
 
 def custom_to_unit(x, y, bounds):
+  x, y = _arrays(x, y)
   ulx, uly, orx, ory = bounds
   dx, dy = orx-ulx, ory-uly
   return (x - ulx) * 2.0 / dx - 1.0, (y-uly) * 2.0 / dy - 1.0
@@ -71,8 +100,124 @@ def custom_to_latlon(x, y, bounds):
   l, m   = unit_to_latlon(u, v)
   return l, m
   
+### reprojection between EPSG coordinate systems - pyproj support ##############################
+# Building a pyproj transformation is far more expensive than using it: build
+# one per (source, target) pair and thread (pyproj objects are not thread
+# safe), and reuse it for every point or array of points.
+
+SRS_ALIASES = {'EPSG:900913': 'EPSG:3857'}
+_reprojections = local()
+
+class Reprojection(object):
+  '''Reprojection from the `source` to the `target` coordinate system, given
+     as EPSG strings ("EPSG:32633"). Coordinates are in x/y order: easting/
+     northing, or lon/lat. Call it with scalars or arrays of x/y.'''
+
+  def __init__(self, source, target):
+    if Proj is None:
+      raise ImportError('pyproj is required to reproject from %s to %s' % (source, target))
+    self.source = source
+    self.target = target
+    if Transformer is not None:
+      self.transformer = Transformer.from_crs(source, target, always_xy=True)
+      self.transform = self.transformer.transform
+    else:
+      psource = Proj(init=source.lower())
+      ptarget = Proj(init=target.lower())
+      self.transform = lambda x, y: transform(psource, ptarget, x, y)
+
+  def __call__(self, x, y):
+    x, y = _arrays(x, y)
+    return self.transform(x, y)
+
+def reprojection(source, target):
+  '''Return the Reprojection from `source` to `target` (EPSG strings),
+     built once per pair and thread'''
+  source = source.upper()
+  target = target.upper()
+  key = (SRS_ALIASES.get(source, source), SRS_ALIASES.get(target, target))
+  cache = getattr(_reprojections, 'cache', None)
+  if cache is None:
+    cache = _reprojections.cache = {}
+  result = cache.get(key)
+  if result is None:
+    result = cache[key] = Reprojection(*key)
+  return result
+
+def srs_to_unit(srs, x, y):
+  '''Projects x/y (scalars or arrays) of the `srs` EPSG system to the bent
+     mercator unit square'''
+  lon, lat = reprojection(srs, 'EPSG:4326')(x, y)
+  return latlon_to_unit(lat, lon)
+
+def unit_to_srs(srs, x, y):
+  '''Unprojects unit square x/y (scalars or arrays) to the `srs` EPSG system'''
+  lat, lon = unit_to_latlon(x, y)
+  return reprojection('EPSG:4326', srs)(lon, lat)
+
+def _srs_of(proj):
+  '''Return the EPSG string of a pyproj Proj, or `proj` if already a string'''
+  if isinstance(proj, basestring):
+    return proj
+  crs = getattr(proj, 'crs', None)
+  if crs is not None and crs.to_epsg() is not None:
+    return 'EPSG:%d' % crs.to_epsg()
+  match = re.search(r'init=epsg:(\d+)', proj.srs, re.I)
+  if match is None:
+    raise ValueError('not an EPSG coordinate system: %s' % proj.srs)
+  return 'EPSG:%s' % match.group(1)
+
+def project_to_unit(proj, x, y):
+  '''Projects any coordinate system to a bent mercator unit square.
+     `proj` is a pyproj Proj of an EPSG system, or its EPSG string.
+     x/y may be arrays, projected with a single pyproj call.'''
+  return srs_to_unit(_srs_of(proj), x, y)
+
+def unit_to_project(proj, x, y):
+  '''Unprojects unit square to any coordinate system.
+     `proj` is a pyproj Proj of an EPSG system, or its EPSG string.
+     x/y may be arrays, projected with a single pyproj call.'''
+  return unit_to_srs(_srs_of(proj), x, y)
+
 ###############################################################################################
 
 def fix180(x):
   '''wrap all coordinates into [-180;180]'''
+  x, = _arrays(x)
   return ((x + 180) % 360) - 180
+
+
+if __name__ == '__main__':
+  # benchmark: per point calls against one call per array
+  from time import time
+  from random import uniform
+  count = 1000000
+  lats = [uniform(-85, 85) for i in xrange(count)]
+  lons = [uniform(-180, 180) for i in xrange(count)]
+
+  def bench(name, loop, batch):
+    start = time()
+    loop()
+    looped = time() - start
+    if numpy is None:
+      print '%-16s %8.3fs per point (numpy not available)' % (name, looped)
+      return
+    start = time()
+    batch()
+    batched = time() - start
+    print '%-16s %8.3fs per point, %8.3fs per array, x%.1f' % (name, looped, batched, looped / batched)
+
+  print 'Converting %d points' % count
+  bench('latlon_to_unit', lambda: [latlon_to_unit(lat, lon) for lat, lon in zip(lats, lons)],
+                          lambda: latlon_to_unit(lats, lons))
+  units = zip(*[latlon_to_unit(lat, lon) for lat, lon in zip(lats, lons)])
+  bench('unit_to_latlon', lambda: [unit_to_latlon(x, y) for x, y in zip(*units)],
+                          lambda: unit_to_latlon(*units))
+  bench('fix180', lambda: [fix180(lon + 360) for lon in lons],
+                  lambda: fix180(numpy.asarray(lons) + 360))
+  if numpy is None or Proj is None:
+    print 'srs_to_unit: pyproj or numpy not available'
+  else:
+    xs, ys = latlon_to_google(lats, lons)
+    bench('srs_to_unit', lambda: [srs_to_unit('EPSG:3857', x, y) for x, y in zip(xs, ys)],
+                         lambda: srs_to_unit('EPSG:3857', xs, ys))
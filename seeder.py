@@ -0,0 +1,307 @@
+'''
+Seeder: download all tiles of a region into the tile cache, for offline use.
+
+Usage::
+
+    python seeder.py -p openstreetmap -m Roadmap -b 59.8,10.5,60.0,10.9 -z 8-14
+    python seeder.py -p bing -m Satellite -z 10-12 \\
+        --polygon "59.9,10.7;60.1,10.9;59.8,11.1"
+
+Tiles already in the cache are skipped. Progress is written to a checkpoint
+file: running the same command again after an interruption resumes where it
+stopped. Keep the seeded area below the provider's cache budget (see
+TILESERVER_CACHE_BUDGET), or the janitor will evict it again.
+'''
+
+__all__ = ('TileSeeder', 'tile_range', 'tile_intersects_polygon')
+
+from threading import Thread, Lock
+from Queue import Queue, Full
+from time import time
+from os.path import exists
+from os import remove
+import json
+
+from projections import *
+from tileaddress import tile_bounds, unit_to_tile
+from TileServer import TileServer
+import WMSTileServer
+
+### static configuration - TODO: parametrize ####################################
+# number of download threads
+SEEDER_POOLSIZE = 8
+# seconds between two checkpoint writes
+SEEDER_CHECKPOINT_INTERVAL = 5
+# seconds between two progress reports
+SEEDER_REPORT_INTERVAL = 1
+# latitude limit of the mercator pyramid
+SEEDER_MAXLAT = 85.0511
+#################################################################################
+
+def latlon_to_tile(lat, lon, zoom):
+  '''Return the (x, y) index of the tile holding lat/lon, y growing southwards'''
+  lat = max(-SEEDER_MAXLAT, min(SEEDER_MAXLAT, lat))
+  u, v = latlon_to_unit(lat, fix180(lon))
+  return unit_to_tile(u, v, zoom)
+
+def tile_range(bbox, zoom):
+  '''Return the inclusive tile range (x1, y1, x2, y2) covering the
+  lat/lon bbox (lat1, lon1, lat2, lon2) at `zoom`'''
+  lat1, lon1, lat2, lon2 = bbox
+  x1, y1 = latlon_to_tile(max(lat1, lat2), min(lon1, lon2), zoom)
+  x2, y2 = latlon_to_tile(min(lat1, lat2), max(lon1, lon2), zoom)
+  return x1, y1, x2, y2
+
+def polygon_bbox(polygon):
+  lats = [lat for lat, lon in polygon]
+  lons = [lon for lat, lon in polygon]
+  return min(lats), min(lons), max(lats), max(lons)
+
+def _inside(px, py, points):
+  '''even-odd rule point in polygon test'''
+  inside = False
+  j = len(points) - 1
+  for i in xrange(len(points)):
+    xi, yi = points[i]
+    xj, yj = points[j]
+    if (yi > py) != (yj > py) and px < (xj - xi) * (py - yi) / (yj - yi) + xi:
+      inside = not inside
+    j = i
+  return inside
+
+def _crosses(a, b, c, d):
+  '''check if segments ab and cd intersect'''
+  def orient(p, q, r):
+    return (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+  return (orient(a, b, c) > 0) != (orient(a, b, d) > 0) and \
+         (orient(c, d, a) > 0) != (orient(c, d, b) > 0)
+
+def tile_intersects_polygon(x, y, zoom, points):
+  '''Check if tile x/y at `zoom` intersects a polygon given as a list of
+  (u, v) points in unit (mercator) coordinates'''
+  u1, v1, u2, v2 = tile_bounds(x, y, zoom)
+  corners = [(u1, v1), (u2, v1), (u2, v2), (u1, v2)]
+  if _inside((u1 + u2) / 2, (v1 + v2) / 2, points):
+    return True
+  for u, v in points:
+    if u1 <= u <= u2 and v1 <= v <= v2:
+      return True
+  for i in xrange(len(points)):
+    a, b = points[i - 1], points[i]
+    for j in xrange(4):
+      if _crosses(a, b, corners[j - 1], corners[j]):
+        return True
+  return False
+
+
+class TileSeeder(object):
+  '''Download every tile of a region through a TileServer provider into its
+  cache, with a pool of worker threads.
+
+    :Parameters:
+        `provider`: str
+            Name of a registered TileServer provider
+        `maptype`: str
+            Map type to download
+        `zooms`: list of int
+            Zoom levels to download
+        `bbox`: tuple, default to None
+            (lat1, lon1, lat2, lon2) area to download
+        `polygon`: list, default to None
+            [(lat, lon), ...] area to download, instead of `bbox`
+        `format`: str, default to 'png'
+            Tile format
+        `poolsize`: int, default to 8
+            Number of download threads
+        `checkpoint`: str, default to None
+            File recording the progress, to resume an interrupted run
+  '''
+
+  def __init__(self, provider, maptype, zooms, bbox=None, polygon=None,
+               format='png', poolsize=SEEDER_POOLSIZE, checkpoint=None):
+    if provider not in TileServer.providers:
+      raise Exception('Unknown map provider %s' % provider)
+    if bbox is None and polygon is None:
+      raise Exception('A bbox or a polygon is required')
+    self.provider   = provider
+    self.maptype    = maptype
+    self.zooms      = sorted(zooms)
+    self.polygon    = polygon
+    self.bbox       = polygon_bbox(polygon) if polygon else bbox
+    self.format     = format
+    self.poolsize   = poolsize
+    self.checkpoint = checkpoint
+    self.server     = TileServer.providers[provider](poolsize=poolsize)
+    if polygon:
+      self.upoints = [latlon_to_unit(lat, fix180(lon)) for lat, lon in polygon]
+
+    self.lock       = Lock()
+    self.queue      = Queue(poolsize * 4)
+    self.pending    = set()  # indexes being downloaded
+    self.position   = 0      # every tile before this index is done
+    self.stats      = dict(downloaded=0, skipped=0, failed=0, bytes=0)
+
+  def job(self):
+    '''Describe the run, to check that a checkpoint belongs to it'''
+    return dict(provider=self.provider, maptype=self.maptype, zooms=self.zooms,
+                bbox=list(self.bbox), polygon=self.polygon, format=self.format)
+
+  def total(self):
+    '''Return the number of tiles in the bbox of the area'''
+    count = 0
+    for zoom in self.zooms:
+      x1, y1, x2, y2 = tile_range(self.bbox, zoom)
+      count += (x2 - x1 + 1) * (y2 - y1 + 1)
+    return count
+
+  def tiles(self):
+    '''Iterate over (index, key) of every tile of the area, in a stable order'''
+    index = 0
+    for zoom in self.zooms:
+      x1, y1, x2, y2 = tile_range(self.bbox, zoom)
+      for y in xrange(y1, y2 + 1):
+        for x in xrange(x1, x2 + 1):
+          index += 1
+          if self.polygon and not tile_intersects_polygon(x, y, zoom, self.upoints):
+            continue
+          yield index - 1, (x, y, zoom, self.maptype, self.format)
+
+  def load_checkpoint(self):
+    if not self.checkpoint or not exists(self.checkpoint):
+      return 0
+    try:
+      with open(self.checkpoint) as fd:
+        state = json.load(fd)
+    except (IOError, ValueError):
+      return 0
+    if state.get('job') != json.loads(json.dumps(self.job())):
+      print 'Checkpoint %s belongs to another run, starting over' % self.checkpoint
+      return 0
+    return state.get('position', 0)
+
+  def save_checkpoint(self):
+    if not self.checkpoint:
+      return
+    with self.lock:
+      position = min(self.pending) if self.pending else self.position
+      state = dict(job=self.job(), position=position, stats=self.stats)
+    with open(self.checkpoint, 'w') as fd:
+      json.dump(state, fd)
+
+  def run(self):
+    '''Download the area, report progress on stdout. Return the statistics.'''
+    start = self.load_checkpoint()
+    if start:
+      print 'Resuming from tile %d' % start
+    self.position = start
+    total = self.total()
+
+    workers = []
+    for i in xrange(self.poolsize):
+      thread = Thread(target=self._worker_run)
+      thread.daemon = True
+      thread.start()
+      workers.append(thread)
+
+    self.started = time()
+    lastreport = lastcheckpoint = self.started
+    for index, key in self.tiles():
+      if index < start:
+        continue
+      with self.lock:
+        self.pending.add(index)
+        self.position = index + 1
+      while True:
+        now = time()
+        if now > lastreport + SEEDER_REPORT_INTERVAL:
+          self.report(total)
+          lastreport = now
+        if now > lastcheckpoint + SEEDER_CHECKPOINT_INTERVAL:
+          self.save_checkpoint()
+          lastcheckpoint = now
+        try:
+          self.queue.put((index, key), timeout=SEEDER_REPORT_INTERVAL)
+          break
+        except Full:
+          pass
+
+    with self.lock:
+      self.position = total
+    for thread in workers:
+      self.queue.put(None)
+    for thread in workers:
+      thread.join()
+    self.server.store.close()
+    self.report(total)
+    print
+    if self.checkpoint and exists(self.checkpoint):
+      remove(self.checkpoint)
+    return self.stats
+
+  def report(self, total):
+    elapsed = max(time() - self.started, 0.001)
+    with self.lock:
+      stats = dict(self.stats)
+      done = stats['downloaded'] + stats['skipped'] + stats['failed']
+    print '\r%d/%d tiles (%d new, %d cached, %d failed) - %.1f tiles/s, %.1f kB/s' % (
+      done, total, stats['downloaded'], stats['skipped'], stats['failed'],
+      stats['downloaded'] / elapsed, stats['bytes'] / elapsed / 1024.),
+
+  def _worker_run(self):
+    store = self.server.store
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      index, key = item
+      try:
+        if store.exists(key):
+          result = 'skipped'
+          size = 0
+        else:
+          size = self.server.download(key)
+          result = size is None and 'failed' or 'downloaded'
+      except:
+        result = 'failed'
+        size = 0
+      with self.lock:
+        self.stats[result] += 1
+        self.stats['bytes'] += size or 0
+        self.pending.discard(index)
+
+
+if __name__ == '__main__':
+  from optparse import OptionParser
+  parser = OptionParser(usage='%prog -p PROVIDER -m MAPTYPE -z ZOOMS (-b BBOX | --polygon POLYGON)')
+  parser.add_option('-p', '--provider', help='tile provider (%s)' % ', '.join(sorted(TileServer.providers)))
+  parser.add_option('-m', '--maptype', default='Roadmap', help='map type [default: %default]')
+  parser.add_option('-z', '--zoom', help='zoom level or range, e.g. 8-14')
+  parser.add_option('-b', '--bbox', help='lat1,lon1,lat2,lon2')
+  parser.add_option('--polygon', help='lat,lon;lat,lon;...')
+  parser.add_option('-f', '--format', default='png', help='tile format [default: %default]')
+  parser.add_option('-w', '--workers', type='int', default=SEEDER_POOLSIZE, help='download threads [default: %default]')
+  parser.add_option('-c', '--checkpoint', help='checkpoint file [default: seed-PROVIDER.json]')
+  options, args = parser.parse_args()
+  if not options.provider or not options.zoom or not (options.bbox or options.polygon):
+    parser.error('provider, zoom and bbox or polygon are required')
+
+  if '-' in options.zoom:
+    z1, z2 = map(int, options.zoom.split('-'))
+    zooms = range(z1, z2 + 1)
+  else:
+    zooms = [int(options.zoom)]
+  bbox = polygon = None
+  if options.polygon:
+    polygon = [tuple(map(float, p.split(','))) for p in options.polygon.split(';')]
+  else:
+    bbox = tuple(map(float, options.bbox.split(',')))
+
+  seeder = TileSeeder(options.provider, options.maptype, zooms, bbox=bbox,
+                      polygon=polygon, format=options.format, poolsize=options.workers,
+                      checkpoint=options.checkpoint or 'seed-%s.json' % options.provider)
+  try:
+    seeder.run()
+  except KeyboardInterrupt:
+    seeder.save_checkpoint()
+    print
+    print 'Interrupted, run the same command again to resume'
@@ -0,0 +1,122 @@
+'''
+Line simplification: levels of detail of the lines and rings of vector
+overlays, with the Douglas-Peucker algorithm.
+
+ranks() runs Douglas-Peucker once, down to the last vertex, and keeps for
+every vertex the distance at which it stops mattering. The level of detail
+for any tolerance is then a simple filter on those ranks (simplified), and
+the levels used for drawing are cached per zoom level (lod).
+
+Coordinates are flat sequences (x, y, x, y, ...) in the unit square.
+
+Run this module to print the vertices drawn per zoom level for a generated
+coastline, and the time taken by the ranking and the filters.
+'''
+
+__all__ = ('ranks', 'simplified', 'zoom_tolerance', 'lod')
+
+from array import array
+
+### static configuration - TODO: parametrize ####################################
+# vertices closer than this to the simplified line are dropped, in pixels
+LOD_PIXELS = 0.5
+#################################################################################
+
+INFINITY = float('inf')
+
+def _distance2(px, py, ax, ay, bx, by):
+    '''Squared distance from p to the segment a-b'''
+    dx, dy = bx - ax, by - ay
+    d = dx * dx + dy * dy
+    if d:
+        t = ((px - ax) * dx + (py - ay) * dy) / d
+        if t > 1:
+            ax, ay = bx, by
+        elif t > 0:
+            ax, ay = ax + t * dx, ay + t * dy
+    return (px - ax) ** 2 + (py - ay) ** 2
+
+def ranks(coords):
+    '''Return the Douglas-Peucker rank of every vertex of a line: the
+    largest tolerance keeping it. The ends are always kept. A closed ring is
+    first split at its vertex farthest from the start.'''
+    n = len(coords) / 2
+    result = array('d', [0.]) * n
+    if n == 0:
+        return result
+    result[0] = result[n - 1] = INFINITY
+    xs, ys = coords[0::2], coords[1::2]
+    stack = []
+    if n > 2 and xs[0] == xs[-1] and ys[0] == ys[-1]:
+        far = max(xrange(1, n - 1), key=lambda i: (xs[i] - xs[0]) ** 2 + (ys[i] - ys[0]) ** 2)
+        result[far] = INFINITY
+        stack = [(0, far, INFINITY), (far, n - 1, INFINITY)]
+    else:
+        stack = [(0, n - 1, INFINITY)]
+    while stack:
+        first, last, limit = stack.pop()
+        if last - first < 2:
+            continue
+        ax, ay, bx, by = xs[first], ys[first], xs[last], ys[last]
+        best, index = -1., first + 1
+        for i in xrange(first + 1, last):
+            d = _distance2(xs[i], ys[i], ax, ay, bx, by)
+            if d > best:
+                best, index = d, i
+        # a vertex never outranks the one that split its parent segment
+        rank = min(best ** .5, limit)
+        result[index] = rank
+        stack.append((first, index, rank))
+        stack.append((index, last, rank))
+    return result
+
+def simplified(coords, ranks, tolerance):
+    '''Return the vertices of `coords` ranked above `tolerance`'''
+    out = array('f')
+    for i, rank in enumerate(ranks):
+        if rank > tolerance:
+            out.append(coords[2 * i])
+            out.append(coords[2 * i + 1])
+    return out
+
+def zoom_tolerance(zoom, tile_size=256, pixels=LOD_PIXELS):
+    '''Return the tolerance in the unit square of `pixels` at `zoom`'''
+    return pixels * 2. / (tile_size * (1 << max(zoom, 0)))
+
+def lod(feature, zoom):
+    '''Return the unit square coordinates of a feature simplified for
+    `zoom`, cached on the feature. Features without ranks are returned
+    whole.'''
+    if feature.ranks is None:
+        return feature.unit
+    if feature.lods is None:
+        feature.lods = dict()
+    coords = feature.lods.get(zoom)
+    if coords is None:
+        coords = feature.lods[zoom] = simplified(feature.unit, feature.ranks, zoom_tolerance(zoom))
+    return coords
+
+
+if __name__ == '__main__':
+    from math import cos, sin, pi
+    from random import gauss, seed
+    from time import time
+
+    # a ragged coastline around a small country: 200000 vertices
+    seed(0)
+    count = 200000
+    radius, coords = 0.05, array('f')
+    for i in xrange(count):
+        radius = max(0.02, min(0.08, radius + gauss(0, 0.0002)))
+        angle = 2 * pi * i / count
+        coords.extend((0.05 + radius * cos(angle), 0.65 + radius * sin(angle)))
+    coords.extend(coords[:2])
+
+    start = time()
+    r = ranks(coords)
+    print 'ranked %d vertices in %.2fs' % (len(r), time() - start)
+    print '%5s %10s %10s' % ('zoom', 'vertices', 'ms')
+    for zoom in xrange(0, 19, 2):
+        start = time()
+        level = simplified(coords, r, zoom_tolerance(zoom))
+        print '%5d %10d %10.1f' % (zoom, len(level) / 2, (time() - start) * 1000)
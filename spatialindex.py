@@ -0,0 +1,118 @@
+'''
+Spatial index: a uniform grid of the features loaded from a vector overlay,
+for hit-testing without asking the server again.
+
+Areas are (xmin, ymin, xmax, ymax) tuples in the coordinates of the features.
+'''
+
+__all__ = ('GridIndex', 'bbox_of', 'point_in_ring')
+
+from math import floor
+
+### static configuration - TODO: parametrize ####################################
+# features spanning more cells than this are kept aside and always tested
+GRID_MAX_CELLS = 64
+#################################################################################
+
+def bbox_of(coords):
+    '''Return the area of flat coordinates (x, y, x, y, ...)'''
+    xs, ys = coords[0::2], coords[1::2]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and \
+           inner[2] <= outer[2] and inner[3] <= outer[3]
+
+def point_in_ring(x, y, coords):
+    '''Return True if x/y is inside the ring of flat coordinates `coords`
+    (even-odd rule)'''
+    inside = False
+    n = len(coords)
+    jx, jy = coords[n - 2], coords[n - 1]
+    for i in xrange(0, n - 1, 2):
+        ix, iy = coords[i], coords[i + 1]
+        if (iy > y) != (jy > y) and x < (jx - ix) * (y - iy) / (jy - iy) + ix:
+            inside = not inside
+        jx, jy = ix, iy
+    return inside
+
+class GridIndex(object):
+    '''Items indexed by their area in the cells of a uniform grid. Also
+    records the areas that were loaded completely (see cover/covers), so
+    that a query can tell whether its answer is final.
+
+    :Parameters:
+        `cellsize`: float
+            Width and height of a cell, in the units of the coordinates
+    '''
+
+    def __init__(self, cellsize):
+        self.cellsize = float(cellsize)
+        self.cells    = dict()  # (i, j) -> [(bbox, item)]
+        self.large    = []      # [(bbox, item)] spanning too many cells
+        self.keys     = set()
+        self.covered  = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def cell_range(self, bbox):
+        s = self.cellsize
+        return (int(floor(bbox[0] / s)), int(floor(bbox[1] / s)),
+                int(floor(bbox[2] / s)), int(floor(bbox[3] / s)))
+
+    def insert(self, key, bbox, item):
+        '''Index `item` by its area, unless an item with the same key is
+        already indexed'''
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        i0, j0, i1, j1 = self.cell_range(bbox)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > GRID_MAX_CELLS:
+            self.large.append((bbox, item))
+            return True
+        entry = (bbox, item)
+        for i in xrange(i0, i1 + 1):
+            for j in xrange(j0, j1 + 1):
+                self.cells.setdefault((i, j), []).append(entry)
+        return True
+
+    def query(self, bbox):
+        '''Return the (area, item) whose area intersects `bbox`'''
+        found = dict()
+        i0, j0, i1, j1 = self.cell_range(bbox)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self.cells):
+            cells = self.cells.itervalues()
+        else:
+            cells = (self.cells.get((i, j), ()) for i in xrange(i0, i1 + 1)
+                                                for j in xrange(j0, j1 + 1))
+        for entries in cells:
+            for entry in entries:
+                if intersects(entry[0], bbox):
+                    found[id(entry[1])] = entry
+        for entry in self.large:
+            if intersects(entry[0], bbox):
+                found[id(entry[1])] = entry
+        return found.values()
+
+    def cover(self, bbox):
+        '''Record that every item of `bbox` is indexed'''
+        if not self.covers(bbox):
+            self.covered = [area for area in self.covered if not contains(bbox, area)]
+            self.covered.append(bbox)
+
+    def covers(self, bbox):
+        '''Return True if `bbox` lies in an area recorded by cover()'''
+        for area in self.covered:
+            if contains(area, bbox):
+                return True
+        return False
+
+    def clear(self):
+        self.cells   = dict()
+        self.large   = []
+        self.keys    = set()
+        self.covered = []
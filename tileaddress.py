@@ -0,0 +1,190 @@
+'''
+Tile addressing: conversions between the tile index schemes of the providers.
+
+Tiles are addressed as (x, y, zoom) in XYZ orientation (Google, OSM, Bing,
+WMTS GoogleMapsCompatible: y grows southwards). Other schemes:
+
+- TMS (MBTiles, WMS-C): y grows northwards, see flip_y
+- quadkey (Bing): one base 4 digit per zoom level, the x and y bits
+  interleaved, see quadkey and quadkey_to_tile
+- Yahoo: y counted from the equator and zoom reversed, see to_yahoo
+
+Every function accepts scalars. The arithmetic ones (flip_y, tile_bounds,
+unit_to_tile, morton) also accept numpy arrays, and quadkeys /
+quadkeys_to_tiles convert whole sequences at once.
+
+Run this module to check the round trips on random tiles and to benchmark
+the quadkey encoding against the previous string based implementation.
+'''
+
+__all__ = ('flip_y', 'to_yahoo', 'morton', 'quadkey', 'quadkeys',
+           'quadkey_to_tile', 'quadkeys_to_tiles', 'tile_bounds',
+           'tile_center', 'unit_to_tile')
+
+from math import floor
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# bits of a byte spread on the even bits of a 16 bits word
+_SPREAD = [sum(((i >> b) & 1) << (2 * b) for b in xrange(8)) for i in xrange(256)]
+# the 4 quadkey digits of a byte of an interleaved index
+_DIGITS = [''.join('0123'[(i >> s) & 3] for s in (6, 4, 2, 0)) for i in xrange(256)]
+# the (x, y) nibbles of a byte of an interleaved index
+_COMPACT = [(sum(((i >> (2 * b)) & 1) << b for b in xrange(4)),
+             sum(((i >> (2 * b + 1)) & 1) << b for b in xrange(4))) for i in xrange(256)]
+
+def _is_array(value):
+  return numpy is not None and isinstance(value, numpy.ndarray)
+
+def flip_y(y, zoom):
+  '''Convert a row between XYZ and TMS orientation (both ways)'''
+  return (1 << zoom) - 1 - y
+
+def to_yahoo(x, y, zoom):
+  '''Return the Yahoo (x, y, z) index of an XYZ tile'''
+  return x, (1 << (zoom - 1)) - y - 1, 18 - zoom
+
+def morton(x, y):
+  '''Interleave the bits of x (even bits) and y (odd bits), up to 32 bits
+     each. x/y may be numpy arrays.'''
+  if _is_array(x) or _is_array(y):
+    return _spread(x) | (_spread(y) << numpy.uint64(1))
+  m = shift = 0
+  while x or y:
+    m |= (_SPREAD[x & 255] | _SPREAD[y & 255] << 1) << shift
+    x >>= 8
+    y >>= 8
+    shift += 16
+  return m
+
+def _spread(v):
+  v = numpy.asarray(v, dtype=numpy.uint64)
+  for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                      (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                      (1, 0x5555555555555555)):
+    v = (v | (v << numpy.uint64(shift))) & numpy.uint64(mask)
+  return v
+
+def _morton_to_quadkey(m, zoom):
+  if not zoom:
+    return ''
+  m = int(m)
+  digits = [_DIGITS[(m >> s) & 255] for s in xrange(((zoom + 3) / 4 - 1) * 8, -8, -8)]
+  return ''.join(digits)[-zoom:]
+
+def quadkey(x, y, zoom):
+  '''Return the quadkey of an XYZ tile'''
+  return _morton_to_quadkey(morton(x, y), zoom)
+
+def quadkeys(xs, ys, zoom):
+  '''Return the quadkeys of sequences of tile columns and rows of a zoom level'''
+  if numpy is not None:
+    codes = morton(numpy.asarray(xs, dtype=numpy.uint64),
+                   numpy.asarray(ys, dtype=numpy.uint64)).tolist()
+  else:
+    codes = map(morton, xs, ys)
+  return [_morton_to_quadkey(m, zoom) for m in codes]
+
+def quadkey_to_tile(key):
+  '''Return the XYZ tile (x, y, zoom) of a quadkey'''
+  if not key:
+    return 0, 0, 0
+  m = int(key, 4)
+  x = y = shift = 0
+  while m:
+    cx, cy = _COMPACT[m & 255]
+    x |= cx << shift
+    y |= cy << shift
+    m >>= 8
+    shift += 4
+  return x, y, len(key)
+
+def quadkeys_to_tiles(keys):
+  '''Return the columns, rows and zoom levels of a sequence of quadkeys, as
+     numpy arrays if numpy is available, lists otherwise'''
+  tiles = zip(*[quadkey_to_tile(key) for key in keys]) or ((), (), ())
+  if numpy is not None:
+    return tuple(numpy.array(column, dtype=int) for column in tiles)
+  return tuple(list(column) for column in tiles)
+
+def tile_bounds(x, y, zoom):
+  '''Return the area (west, south, east, north) of an XYZ tile in the bent
+     mercator unit square [-1,1] x [-1,1]. x/y may be numpy arrays.'''
+  tz = float(1 << zoom)
+  return 2 * x / tz - 1, 1 - 2 * (y + 1) / tz, 2 * (x + 1) / tz - 1, 1 - 2 * y / tz
+
+def tile_center(x, y, zoom):
+  '''Return the centre (u, v) of an XYZ tile in the unit square'''
+  tz = float(1 << zoom)
+  return 2 * (x + .5) / tz - 1, 1 - 2 * (y + .5) / tz
+
+def unit_to_tile(u, v, zoom):
+  '''Return the XYZ tile (x, y) holding unit square u/v, clamped to the
+     pyramid. u/v may be numpy arrays.'''
+  tz = 1 << zoom
+  x = (u + 1) / 2.0 * tz
+  y = (1 - v) / 2.0 * tz
+  if _is_array(x) or _is_array(y):
+    return (numpy.clip(numpy.floor(x), 0, tz - 1).astype(int),
+            numpy.clip(numpy.floor(y), 0, tz - 1).astype(int))
+  return min(max(int(floor(x)), 0), tz - 1), min(max(int(floor(y)), 0), tz - 1)
+
+
+if __name__ == '__main__':
+  from random import randint, random
+  from time import time
+
+  def legacy_quadkey(col, row, zoom):
+    '''the string based implementation previously used by BingTileServer'''
+    octalStrings = ('000', '001', '010', '011', '100', '101', '110', '111')
+    microsoftToCorners = {'00': '0', '01': '1', '10': '2', '11': '3'}
+    def toBinaryString(i):
+      return ''.join([octalStrings[int(c)] for c in oct(i)]).lstrip('0')
+    y, x = toBinaryString(row).rjust(zoom, '0'), toBinaryString(col).rjust(zoom, '0')
+    return ''.join([microsoftToCorners[y[c]+x[c]] for c in range(zoom)])
+
+  # round trips on random tiles
+  count = 20000
+  for i in xrange(count):
+    zoom = randint(0, 30)
+    x, y = randint(0, (1 << zoom) - 1), randint(0, (1 << zoom) - 1)
+    key = quadkey(x, y, zoom)
+    assert len(key) == zoom, (x, y, zoom, key)
+    assert quadkey_to_tile(key) == (x, y, zoom), (x, y, zoom, key)
+    assert flip_y(flip_y(y, zoom), zoom) == y
+    if 0 < zoom < 20:
+      assert key == legacy_quadkey(x, y, zoom), (x, y, zoom, key)
+    u, v = tile_center(x, y, zoom)
+    assert unit_to_tile(u, v, zoom) == (x, y), (x, y, zoom)
+    west, south, east, north = tile_bounds(x, y, zoom)
+    assert west < u < east and south < v < north
+    assert unit_to_tile(west, north, zoom) == (x, y), (x, y, zoom)
+    u, v = random() * 2 - 1, random() * 2 - 1
+    tx, ty = unit_to_tile(u, v, zoom)
+    west, south, east, north = tile_bounds(tx, ty, zoom)
+    assert west <= u <= east and south <= v <= north, (u, v, zoom)
+  zoom = 17
+  xs = [randint(0, (1 << zoom) - 1) for i in xrange(count)]
+  ys = [randint(0, (1 << zoom) - 1) for i in xrange(count)]
+  keys = quadkeys(xs, ys, zoom)
+  assert keys == [quadkey(x, y, zoom) for x, y in zip(xs, ys)]
+  cols, rows, zooms = quadkeys_to_tiles(keys)
+  assert list(cols) == xs and list(rows) == ys and set(zooms) == set([zoom])
+  print '%d round trips OK' % count
+
+  # quadkey microbenchmark
+  def bench(name, function):
+    start = time()
+    function()
+    elapsed = time() - start
+    print '%-26s %8.3fs, %6.2f us/tile' % (name, elapsed, elapsed * 1e6 / count)
+    return elapsed
+  pairs = zip(xs, ys)
+  legacy = bench('legacy quadkey', lambda: [legacy_quadkey(x, y, zoom) for x, y in pairs])
+  scalar = bench('quadkey', lambda: [quadkey(x, y, zoom) for x, y in pairs])
+  bulk = bench('quadkeys (bulk)', lambda: quadkeys(xs, ys, zoom))
+  bench('quadkey_to_tile', lambda: [quadkey_to_tile(key) for key in keys])
+  print 'quadkey speedup: x%.1f, bulk x%.1f' % (legacy / scalar, legacy / bulk)
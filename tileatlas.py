@@ -0,0 +1,186 @@
+'''
+Tile atlas: pack decoded tiles into a few large textures, and draw them in
+retained batches with one Mesh per texture, instead of one Rectangle per tile
+'''
+
+__all__ = ('TileAtlas', 'AtlasTile', 'TileBatch', 'crop_tex_coords')
+
+from kivy.graphics import Color, Mesh, InstructionGroup
+from kivy.graphics.texture import Texture
+
+### static configuration - TODO: parametrize ####################################
+# size of an atlas page (2048 is supported by every GLES 2 device we know)
+ATLAS_SIZE = 2048
+#################################################################################
+
+class AtlasTile(object):
+    '''A tile stored in a slot of an atlas page. `texture` is a region of the
+    page, usable like any kivy texture.'''
+    __slots__ = ('id', 'texture', 'loaded', 'alpha', 'slot')
+
+    def __init__(self, id, texture, slot):
+        self.id      = id
+        self.texture = texture
+        self.loaded  = True
+        self.alpha   = 0
+        self.slot    = slot
+
+def crop_tex_coords(tex_coords, x, y, size):
+    '''Return the tex_coords of the square area (x, y, size) of a texture
+    region given by its `tex_coords`. x, y and size are fractions of the
+    region, y growing upwards.'''
+    u0, v0, u1, v1, u2, v2, u3, v3 = tex_coords
+    du, dv = u1 - u0, v1 - v0  # along the bottom edge
+    eu, ev = u3 - u0, v3 - v0  # along the left edge
+    x2, y2 = x + size, y + size
+    return (u0 + x * du + y * eu, v0 + x * dv + y * ev,
+            u0 + x2 * du + y * eu, v0 + x2 * dv + y * ev,
+            u0 + x2 * du + y2 * eu, v0 + x2 * dv + y2 * ev,
+            u0 + x * du + y2 * eu, v0 + x * dv + y2 * ev)
+
+class TileAtlas(object):
+    '''Atlas pages for tiles of a fixed size. Slots are recycled with
+    release(), usually when the tile is evicted from the memory cache.
+
+    :Parameters:
+        `tile_size`: tuple, default to (256, 256)
+            Size of the tiles
+        `size`: int, default to 2048
+            Size of the pages
+    '''
+
+    def __init__(self, tile_size=(256, 256), size=ATLAS_SIZE):
+        self.tile_size = tile_size
+        self.size      = size
+        self.pages     = []
+        self.free      = []  # (page index, x, y)
+
+    def accepts(self, decoded):
+        return decoded.size == self.tile_size
+
+    def upload(self, decoded, id):
+        '''Copy a decoded tile into a free slot and return an AtlasTile.
+        Must be called from the main thread.'''
+        if not self.free:
+            self.add_page()
+        slot = self.free.pop()
+        page, x, y = slot
+        w, h = self.tile_size
+        texture = self.pages[page]
+        texture.blit_buffer(decoded.pixels, pos=(x, y), size=(w, h),
+                            colorfmt='rgba', bufferfmt='ubyte')
+
+        # rows are stored top row first, so flip the region. Keep half a texel
+        # away from the slot border, so that filtering never samples the
+        # neighbour tile.
+        region = texture.get_region(x, y, w, h)
+        s = float(self.size)
+        region.uvpos  = ((x + .5) / s, (y + h - .5) / s)
+        region.uvsize = ((w - 1) / s, -(h - 1) / s)
+        return AtlasTile(id, region, slot)
+
+    def release(self, tile):
+        '''Give the slot of a tile back'''
+        if tile.slot is not None:
+            self.free.append(tile.slot)
+            tile.slot = None
+
+    def add_page(self):
+        texture = Texture.create(size=(self.size, self.size), colorfmt='rgba')
+        texture.mag_filter = 'linear'
+        texture.min_filter = 'linear'
+        index = len(self.pages)
+        self.pages.append(texture)
+        w, h = self.tile_size
+        for y in xrange(self.size / h - 1, -1, -1):
+            for x in xrange(self.size / w - 1, -1, -1):
+                self.free.append((index, x * w, y * h))
+
+
+class TileBatch(object):
+    '''Retained textured quads, grouped by texture and alpha into one
+    Color + Mesh per group.
+
+    Every frame, call begin(), add() every quad to draw, then commit(): the
+    meshes are only rebuilt for the groups whose quads changed since the
+    previous frame. `group` is the InstructionGroup to add to a canvas.
+    '''
+
+    def __init__(self):
+        self.group  = InstructionGroup()
+        self.meshes = dict()  # (texture id, alpha) -> (InstructionGroup, Mesh)
+        self.quads  = dict()  # quad key -> ((texture id, alpha), texture, vertices)
+        self.frame  = dict()
+
+    @property
+    def drawcalls(self):
+        return len(self.meshes)
+
+    def begin(self):
+        self.frame = dict()
+
+    def add(self, key, texture, x, y, w, h, alpha, tex_coords=None):
+        '''Add a quad at x/y of size w/h, sampling `tex_coords` (bottom-left,
+        bottom-right, top-right, top-left) of `texture`, or the whole texture.
+        `key` identifies the quad from one frame to the next.'''
+        u0, v0, u1, v1, u2, v2, u3, v3 = tex_coords or texture.tex_coords
+        self.frame[key] = ((texture.id, alpha), texture,
+                           (x, y, u0, v0, x + w, y, u1, v1,
+                            x + w, y + h, u2, v2, x, y + h, u3, v3))
+
+    def commit(self):
+        '''Update the meshes of the groups that changed. Return the number of
+        meshes rebuilt.'''
+        frame, quads = self.frame, self.quads
+        dirty = set()
+        for key, quad in frame.iteritems():
+            old = quads.get(key)
+            if old is None or old[0] != quad[0] or old[2] != quad[2]:
+                dirty.add(quad[0])
+                if old is not None:
+                    dirty.add(old[0])
+        for key, quad in quads.iteritems():
+            if key not in frame:
+                dirty.add(quad[0])
+        self.quads = frame
+        if not dirty:
+            return 0
+
+        bygroup = dict((gkey, []) for gkey in dirty)
+        for gkey, texture, vertices in frame.itervalues():
+            if gkey in bygroup:
+                bygroup[gkey].append((texture, vertices))
+        for gkey, members in bygroup.iteritems():
+            self.update_group(gkey, members)
+        return len(dirty)
+
+    def update_group(self, gkey, members):
+        old = self.meshes.pop(gkey, None)
+        if not members:
+            if old is not None:
+                self.group.remove(old[0])
+            return
+        vertices, indices = [], []
+        for i, (texture, quad) in enumerate(members):
+            vertices.extend(quad)
+            j = i * 4
+            indices.extend((j, j + 1, j + 2, j + 2, j + 3, j))
+        if old is not None:
+            group, mesh = old
+            mesh.vertices = vertices
+            mesh.indices = indices
+        else:
+            group = InstructionGroup()
+            group.add(Color(1, 1, 1, gkey[1]))
+            mesh = Mesh(vertices=vertices, indices=indices, mode='triangles',
+                        texture=members[0][0])
+            group.add(mesh)
+            # fading tiles are added last, on top of the opaque ones
+            self.group.add(group)
+        self.meshes[gkey] = (group, mesh)
+
+    def clear(self):
+        '''Remove every quad'''
+        self.group.clear()
+        self.meshes = dict()
+        self.quads = dict()
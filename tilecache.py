@@ -0,0 +1,108 @@
+'''
+Tile memory cache: decoded tiles kept in memory under a byte budget
+'''
+
+__all__ = ('TileMemoryCache', )
+
+from collections import OrderedDict
+
+### static configuration - TODO: parametrize ####################################
+# bytes accounted for a tile whose size is not known yet (256x256 RGBA)
+TILECACHE_DEFAULT_SIZE = 256 * 256 * 4
+#################################################################################
+
+class TileMemoryCache(object):
+    '''LRU cache of decoded tiles, bounded by the size of their textures.
+
+    Pinned tiles (the ones currently in view) are never evicted, so the
+    cache may temporarily exceed its budget when the viewport alone does not
+    fit. Must only be used from the main thread.
+
+    :Parameters:
+        `budget`: int
+            Maximum size of the cached textures in bytes
+        `on_evict`: callable, default to None
+            Called with every evicted tile
+    '''
+
+    def __init__(self, budget, on_evict=None):
+        self.budget  = budget
+        self.on_evict = on_evict
+        self.entries = OrderedDict()  # key -> (image, size), oldest first
+        self.size    = 0
+        self.pinned  = frozenset()
+        self.stats   = dict(hits=0, misses=0, evictions=0)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def info(self):
+        '''Return cache statistics'''
+        stats = dict(self.stats)
+        stats['cached'] = len(self.entries)
+        stats['cached_bytes'] = self.size
+        return stats
+
+    def get(self, key):
+        '''Return a cached tile and mark it as recently used, or None'''
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+        self.entries[key] = entry
+        self.stats['hits'] += 1
+        return entry[0]
+
+    def peek(self, key):
+        '''Like get, without counting a hit or a miss'''
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.entries[key] = entry
+        return entry[0]
+
+    def put(self, key, image, size=None):
+        '''Add a tile, accounted for `size` bytes if given, else for the size
+        of its texture'''
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+            if self.on_evict and old[0] is not image:
+                self.on_evict(old[0])
+        if size is None:
+            size = self.image_size(image)
+        self.entries[key] = (image, size)
+        self.size += size
+        self.evict()
+
+    def pin(self, keys):
+        '''Replace the set of tiles protected from eviction'''
+        self.pinned = frozenset(keys)
+        self.evict()
+
+    def evict(self):
+        if self.size <= self.budget:
+            return
+        for key in self.entries.keys():
+            if key in self.pinned:
+                continue
+            image, size = self.entries.pop(key)
+            self.size -= size
+            self.stats['evictions'] += 1
+            if self.on_evict:
+                self.on_evict(image)
+            if self.size <= self.budget:
+                return
+
+    def image_size(self, image):
+        '''Return the memory used by the texture of a tile'''
+        if not getattr(image, 'loaded', True):
+            return TILECACHE_DEFAULT_SIZE # still showing the loading image
+        try:
+            w, h = image.texture.size
+            return w * h * 4
+        except:
+            return TILECACHE_DEFAULT_SIZE
@@ -0,0 +1,68 @@
+'''
+Tile decoder: turn encoded tiles (png, jpg) into raw RGBA pixels, without
+touching OpenGL, so that it can run inside the TileServer workers.
+
+Uses PIL if available, pygame otherwise. Slicing metatiles needs PIL.
+'''
+
+__all__ = ('DecodedTile', 'decode_tile', 'can_decode', 'slice_tiles', 'can_slice')
+
+from StringIO import StringIO
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+try:
+    import pygame
+except ImportError:
+    pygame = None
+
+class DecodedTile(object):
+    '''Raw RGBA pixels of a tile, top row first'''
+    __slots__ = ('width', 'height', 'pixels')
+
+    def __init__(self, width, height, pixels):
+        self.width  = width
+        self.height = height
+        self.pixels = pixels
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+def can_decode():
+    '''Check if a decoder library is available'''
+    return PILImage is not None or pygame is not None
+
+def decode_tile(data, format='png'):
+    '''Decode an encoded tile into a DecodedTile.
+    Raise an exception if the data cannot be decoded.'''
+    if PILImage is not None:
+        image = PILImage.open(StringIO(data)).convert('RGBA')
+        tobytes = getattr(image, 'tobytes', None) or image.tostring
+        return DecodedTile(image.size[0], image.size[1], tobytes())
+    if pygame is not None:
+        surface = pygame.image.load(StringIO(data), 'tile.%s' % format)
+        width, height = surface.get_size()
+        return DecodedTile(width, height, pygame.image.tostring(surface, 'RGBA'))
+    raise Exception('No image decoder available (PIL or pygame)')
+
+def can_slice():
+    '''Check if metatiles can be sliced'''
+    return PILImage is not None
+
+def slice_tiles(data, cols, rows, tile_size=(256, 256)):
+    '''Cut an encoded image of cols x rows tiles into PNG encoded tiles.
+    Return {(col, row): data}, row 0 being the top row.'''
+    image = PILImage.open(StringIO(data))
+    image.load()
+    w, h = tile_size
+    tiles = {}
+    for row in xrange(rows):
+        for col in xrange(cols):
+            out = StringIO()
+            image.crop((col * w, row * h, (col + 1) * w, (row + 1) * h)).save(out, 'PNG')
+            tiles[(col, row)] = out.getvalue()
+    return tiles
@@ -0,0 +1,188 @@
+'''
+Tile scheduler: priority queue of tile requests for the TileServer workers
+'''
+
+__all__ = ('TileScheduler', )
+
+from heapq import heappush, heappop, heapify
+from threading import Condition
+from math import hypot
+
+class TileScheduler(object):
+    '''Thread safe priority queue of tile requests.
+
+    Requests are keyed by (nx, ny, zoom, maptype, format), with nx/ny in
+    tile server orientation (y grows southwards). Tiles of the current zoom
+    level are served first, then the nearest zoom levels; inside a level,
+    tiles closest to the viewport centre go first. Whenever the viewport
+    changes, queued requests that fell out of view are dropped and the
+    rest are reordered.
+
+    Prefetch requests (see prefetch) always come after visible ones, and
+    at most `prefetch_slots` of them are downloaded at the same time, so
+    that a worker is always left for the visible tiles.
+
+    The viewport is expressed in world fractions: x and y in [0, 1[,
+    wrapped around like the map plane.
+    '''
+
+    def __init__(self, prefetch_slots=1):
+        self.heap      = []
+        self.queued    = dict()  # key -> heap entry
+        self.inflight  = set()
+        self.prefetching = set()  # prefetch requests in flight
+        self.prefetch_slots = prefetch_slots
+        self.condition = Condition()
+        self.viewport  = None
+        self.seq       = 0
+        self.stats     = dict(pushed=0, dropped=0, done=0, prefetched=0)
+
+    def __len__(self):
+        return len(self.queued) + len(self.inflight)
+
+    def __contains__(self, key):
+        return key in self.queued or key in self.inflight
+
+    def depth(self):
+        '''Return queue depth statistics'''
+        with self.condition:
+            stats = dict(self.stats)
+            stats['queued'] = len(self.queued)
+            stats['inflight'] = len(self.inflight)
+            stats['prefetching'] = len(self.prefetching)
+        return stats
+
+    def push(self, key):
+        '''Queue a tile request, unless it is already queued or loading'''
+        with self.condition:
+            entry = self.queued.get(key)
+            if entry is not None and entry[4]:
+                # wanted now: promote the prefetch request
+                entry[3] = False
+                del self.queued[key]
+            elif entry is not None or key in self.inflight:
+                return
+            self._push(key, False)
+            self.stats['pushed'] += 1
+            self.condition.notify()
+
+    def prefetch(self, keys, limit):
+        '''Replace the queued prefetch requests by the first `limit` keys
+        not already queued or loading'''
+        with self.condition:
+            wanted = set(keys)
+            for key, entry in self.queued.items():
+                if entry[4] and key not in wanted:
+                    entry[3] = False
+                    del self.queued[key]
+            count = sum(1 for entry in self.queued.itervalues() if entry[4])
+            for key in keys:
+                if count >= limit:
+                    break
+                if key in self.queued or key in self.inflight:
+                    continue
+                self._push(key, True)
+                self.stats['prefetched'] += 1
+                count += 1
+            self.condition.notify()
+
+    def _push(self, key, prefetch):
+        self.seq += 1
+        entry = [self.priority(key, prefetch), self.seq, key, True, prefetch]
+        self.queued[key] = entry
+        heappush(self.heap, entry)
+
+    def pop(self, timeout=None):
+        '''Return the most urgent request and mark it in flight. Block up to
+        `timeout` seconds if there is nothing to do, then return None.
+        '''
+        with self.condition:
+            key = self._pop()
+            if key is None:
+                self.condition.wait(timeout)
+                key = self._pop()
+        return key
+
+    def _pop(self):
+        heap = self.heap
+        while heap:
+            entry = heap[0]
+            if not entry[3]:
+                heappop(heap)
+                continue
+            key = entry[2]
+            if entry[4]:
+                if len(self.prefetching) >= self.prefetch_slots:
+                    return None
+                self.prefetching.add(key)
+            heappop(heap)
+            del self.queued[key]
+            self.inflight.add(key)
+            return key
+        return None
+
+    def done(self, key):
+        '''Mark an in flight request as finished'''
+        with self.condition:
+            self.inflight.discard(key)
+            if key in self.prefetching:
+                self.prefetching.discard(key)
+                self.condition.notify()
+            self.stats['done'] += 1
+
+    def wakeup(self):
+        '''Release all waiting workers (used on stop)'''
+        with self.condition:
+            self.condition.notify_all()
+
+    def set_viewport(self, zoom, bbox):
+        '''Set the visible area: `zoom` is the zoom level displayed, `bbox`
+        is (x1, y1, x2, y2) in world fractions. Drop queued requests out of
+        view, and reorder the others.
+        '''
+        with self.condition:
+            self.viewport = (zoom, bbox)
+            heap = []
+            for key, entry in self.queued.items():
+                if not entry[4] and not self.visible(key):
+                    entry[3] = False
+                    del self.queued[key]
+                    self.stats['dropped'] += 1
+                    continue
+                entry[0] = self.priority(key, entry[4])
+                heap.append(entry)
+            heapify(heap)
+            self.heap = heap
+
+    def visible(self, key):
+        '''Check if a tile intersects the viewport, with a margin of one tile
+        of the displayed zoom level.'''
+        if self.viewport is None:
+            return True
+        nx, ny, z = key[:3]
+        zoom, (x1, y1, x2, y2) = self.viewport
+        if z > zoom + 1:
+            return False
+        tz = float(pow(2, z))
+        margin = 1.0 / pow(2, zoom)
+        dx = _wrap((nx + 0.5) / tz - (x1 + x2) / 2.)
+        dy = _wrap((ny + 0.5) / tz - (y1 + y2) / 2.)
+        return abs(dx) <= (x2 - x1 + 1.0 / tz) / 2. + margin and \
+               abs(dy) <= (y2 - y1 + 1.0 / tz) / 2. + margin
+
+    def priority(self, key, prefetch=False):
+        '''Return the sort key of a request: visible before prefetch, then
+        zoom distance to the displayed level, then distance to the viewport
+        centre in tiles.'''
+        if self.viewport is None:
+            return (int(prefetch), 0, 0)
+        nx, ny, z = key[:3]
+        zoom, (x1, y1, x2, y2) = self.viewport
+        tz = float(pow(2, z))
+        dx = _wrap((nx + 0.5) / tz - (x1 + x2) / 2.)
+        dy = _wrap((ny + 0.5) / tz - (y1 + y2) / 2.)
+        return (int(prefetch), abs(zoom - z), hypot(dx, dy) * tz)
+
+def _wrap(d):
+    '''wrap a world fraction difference into [-0.5;0.5['''
+    return ((d + 0.5) % 1.0) - 0.5